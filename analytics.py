@@ -0,0 +1,97 @@
+import json
+from collections import defaultdict
+
+import torch
+
+
+def source_names(journal_names):
+    """
+    Source tags of the corpus: every journal of `journal_names.json` (plus
+    "other" for anything else) crossed with the document type.
+    """
+    return [f"{journal}/{doc_type}" for journal in journal_names + ["other"] for doc_type in ("fulltext", "abstract")]
+
+
+def source_id(source_index, journal, doc_type):
+    """Index in `source_names` of a document; unknown journals map to "other"."""
+    if journal not in source_index["journals"]:
+        journal = "other"
+    return source_index["ids"][f"{journal}/{'abstract' if doc_type == 'abstract' else 'fulltext'}"]
+
+
+def build_source_index(journal_names):
+    names = source_names(journal_names)
+    return {"journals": set(journal_names), "ids": {name: idx for idx, name in enumerate(names)}}
+
+
+class LossAnalytics:
+    """
+    Streaming per-source and per-document NLL/token statistics from the
+    per-token losses of the training forward pass.
+
+    Per-source sums live on the device and are reduced across ranks when
+    reported. Per-document sums are folded into a host dict at report time;
+    since a document's chunks can land on several ranks, they are written
+    per rank and summed offline.
+    """
+    def __init__(self, names, device):
+        self.names = names
+        self.nll = torch.zeros(len(names), dtype=torch.float64, device=device)
+        self.tokens = torch.zeros(len(names), dtype=torch.float64, device=device)
+        self.doc_nll = defaultdict(float)
+        self.doc_tokens = defaultdict(int)
+        self._pending_docs = []
+
+    def update(self, token_loss, labels, source_ids, doc_ids):
+        """All arguments are aligned (batch, seq) tensors of the shifted targets."""
+        mask = labels != -1
+        token_loss = token_loss.detach()[mask].double()
+        # Stored as int16, and index_add_ needs int64 indices
+        source_ids = source_ids[mask].long()
+        self.nll.index_add_(0, source_ids, token_loss)
+        self.tokens.index_add_(0, source_ids, torch.ones_like(token_loss))
+
+        docs, inverse = torch.unique(doc_ids[mask], return_inverse=True)
+        doc_nll = torch.zeros(len(docs), dtype=torch.float64, device=docs.device).index_add_(0, inverse, token_loss)
+        doc_tokens = torch.bincount(inverse, minlength=len(docs))
+        self._pending_docs.append((docs, doc_nll, doc_tokens))
+
+    def _fold_docs(self):
+        for docs, doc_nll, doc_tokens in self._pending_docs:
+            for doc, nll, tokens in zip(docs.tolist(), doc_nll.tolist(), doc_tokens.tolist()):
+                self.doc_nll[doc] += nll
+                self.doc_tokens[doc] += tokens
+        self._pending_docs = []
+
+    def reduce(self, accelerator):
+        """Per-source (nll, tokens) summed over ranks. Must be called on every rank."""
+        self._fold_docs()
+        nll = accelerator.reduce(self.nll.clone(), reduction="sum")
+        tokens = accelerator.reduce(self.tokens.clone(), reduction="sum")
+        return nll.tolist(), tokens.tolist()
+
+    def summary(self, nll, tokens):
+        """Per-source, per-journal and per-document-type NLL/token and token share."""
+        total_tokens = max(sum(tokens), 1)
+        groups = {"source": defaultdict(lambda: [0., 0.]), "journal": defaultdict(lambda: [0., 0.]), "doc_type": defaultdict(lambda: [0., 0.])}
+        for name, source_nll, source_tokens in zip(self.names, nll, tokens):
+            if source_tokens == 0:
+                continue
+            journal, doc_type = name.rsplit("/", 1)
+            for group, key in [("source", name), ("journal", journal), ("doc_type", doc_type)]:
+                groups[group][key][0] += source_nll
+                groups[group][key][1] += source_tokens
+        return {
+            group: {
+                key: {"nll_per_token": group_nll / group_tokens, "tokens": int(group_tokens), "share": group_tokens / total_tokens}
+                for key, (group_nll, group_tokens) in stats.items()
+            }
+            for group, stats in groups.items()
+        }
+
+    def write_docs(self, fpath):
+        """Per-document (nll, tokens) seen by this rank, one JSON object per line."""
+        self._fold_docs()
+        with open(fpath, "w") as f:
+            for doc in sorted(self.doc_tokens):
+                f.write(json.dumps({"doc_id": doc, "nll": self.doc_nll[doc], "tokens": self.doc_tokens[doc]}) + "\n")
@@ -0,0 +1,69 @@
+"""
+Gradient all-reduce volume of one epoch with and without `no_sync` on
+non-final micro-batches, on a multi-process CPU `gloo` group.
+
+    python benchmarks/comm_volume.py --world_size 2 --num_batches 20 --gradient_accumulation_steps 8
+"""
+import os
+import sys
+import argparse
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comm_utils import register_comm_counter, accumulation_group
+
+
+def run_epoch(model, optimizer, args, use_no_sync):
+    counter = register_comm_counter(model)
+    num_updates = 0
+    for i in range(args.num_batches):
+        group_size, sync_step = accumulation_group(i, args.num_batches, args.gradient_accumulation_steps)
+        ctx = model.no_sync() if use_no_sync and not sync_step else contextlib.nullcontext()
+        with ctx:
+            x = torch.randn(4, args.hidden_size)
+            loss = model(x).pow(2).mean() / group_size
+            loss.backward()
+        if sync_step:
+            optimizer.step()
+            optimizer.zero_grad()
+            num_updates += 1
+    return counter, num_updates
+
+
+def worker(rank, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.master_port)
+    dist.init_process_group(backend="gloo", rank=rank, world_size=args.world_size)
+    torch.manual_seed(0)
+    results = {}
+    for use_no_sync in (False, True):
+        model = DDP(torch.nn.Sequential(
+            torch.nn.Linear(args.hidden_size, args.hidden_size),
+            torch.nn.ReLU(),
+            torch.nn.Linear(args.hidden_size, args.hidden_size),
+        ))
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+        results[use_no_sync] = run_epoch(model, optimizer, args, use_no_sync)
+    if rank == 0:
+        for use_no_sync, (counter, num_updates) in results.items():
+            name = "no_sync" if use_no_sync else "sync every micro-batch"
+            print(f"{name:>24}: {counter.calls} all-reduces | {counter.bytes / 2**20:.2f} MiB | {num_updates} updates")
+        ratio = results[False][0].bytes / results[True][0].bytes
+        print(f"Reduction: {ratio:.2f}x")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gradient all-reduce volume with and without no_sync")
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--num_batches", type=int, default=20)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=8)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--master_port", type=int, default=29517)
+    args = parser.parse_args()
+    mp.spawn(worker, args=(args,), nprocs=args.world_size)
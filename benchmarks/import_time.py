@@ -0,0 +1,49 @@
+"""
+Startup time of `finetune.py --help` and `finetune.py --dry_run`, against the
+time it takes just to import the training dependencies.
+
+    python benchmarks/import_time.py --repeats 5
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_command(command, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main(args):
+    commands = {
+        "python -c pass": [sys.executable, "-c", "pass"],
+        "finetune.py --help": [sys.executable, "finetune.py", "--help"],
+        "finetune.py --dry_run": [sys.executable, "finetune.py", "--dry_run", "--outputdir", ROOT] + args.dry_run_args,
+        "import training deps": [
+            sys.executable, "-c", "import torch, transformers, datasets, peft, accelerate",
+        ],
+    }
+    for name, command in commands.items():
+        print(f"{name:>24}: {time_command(command, args.repeats):.3f}s (median of {args.repeats})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="finetune.py startup time")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "dry_run_args",
+        nargs=argparse.REMAINDER,
+        help="Extra finetune.py arguments for the --dry_run timing",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,98 @@
+"""
+Base model load time, time to first training step and peak RSS, loading the
+original checkpoint (as `finetune.py` did) versus the converted fp16/bf16
+safetensors cache of `--weights_cache_dir`. Each measurement runs in a fresh
+process; use a small model on CPU.
+
+    python benchmarks/model_load.py --model_path /path/to/small_model --cache_dir /tmp/weights_cache
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from finetune import weights_cache_path, convert_weights
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def measure(args):
+    """Worker: load once, take one forward/backward step, print JSON."""
+    start = time.perf_counter()
+    import torch
+    from transformers import AutoModelForCausalLM
+    imported = time.perf_counter()
+
+    if args.mode == "baseline":
+        model = AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float16)
+    else:
+        cache_path = weights_cache_path(args.model_path, args.cache_dir, args.dtype)
+        dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}[args.dtype]
+        model = AutoModelForCausalLM.from_pretrained(cache_path, torch_dtype=dtype, low_cpu_mem_usage=True)
+    loaded = time.perf_counter()
+
+    loaded_rss_mb = current_rss_mb()
+
+    input_ids = torch.randint(0, model.config.vocab_size, (1, args.seq_len))
+    model(input_ids=input_ids, labels=input_ids).loss.backward()
+    stepped = time.perf_counter()
+
+    print(json.dumps({
+        "import_s": imported - start,
+        "load_s": loaded - imported,
+        # Time to first step includes importing torch/transformers
+        "first_step_s": stepped - start,
+        "loaded_rss_mb": loaded_rss_mb,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def run_worker(args, mode):
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker", "--mode", mode,
+        "--model_path", args.model_path, "--cache_dir", args.cache_dir,
+        "--dtype", args.dtype, "--seq_len", str(args.seq_len),
+    ]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    cache_path = weights_cache_path(args.model_path, args.cache_dir, args.dtype)
+    if not os.path.exists(cache_path):
+        os.makedirs(args.cache_dir, exist_ok=True)
+        start = time.perf_counter()
+        convert_weights(args.model_path, cache_path, args.dtype)
+        print(f"One-time conversion to {cache_path}: {time.perf_counter() - start:.2f}s")
+
+    for mode in ["baseline", "cached"]:
+        results = [run_worker(args, mode) for _ in range(args.repeats)]
+        summary = " | ".join(
+            f"{key} {statistics.median(result[key] for result in results):.2f}" for key in results[0]
+        )
+        print(f"{mode:>8}: {summary} (median of {args.repeats})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Base model load time and RSS with and without the weights cache")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, default="/tmp/weights_cache")
+    parser.add_argument("--dtype", type=str, default="bf16", choices=["fp16", "bf16"])
+    parser.add_argument("--seq_len", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--mode", type=str, default="baseline", choices=["baseline", "cached"])
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        measure(args)
+    else:
+        main(args)
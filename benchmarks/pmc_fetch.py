@@ -0,0 +1,113 @@
+"""
+Articles downloaded by `data/fetch_fulltext.py` against a local stand-in of
+the PMC eutils endpoints, with overlapping journal queries.
+
+A per-journal download (what running pubget once per journal does) transfers
+every article once per journal that matches it; the orchestrator transfers
+each article once, and nothing on a second run with a warm cache.
+
+    python benchmarks/pmc_fetch.py --num_articles 2000 --latency 0.05
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOURNALS = ["Neuron", "Journal of Neuroscience", "eLife", "Nature Communications", "PNAS"]
+
+
+def make_corpus(num_articles, seed=1):
+    """{pmcid: journals matched by the article}; subset-journal queries overlap the others."""
+    rng = random.Random(seed)
+    corpus = {}
+    for pmcid in range(1000000, 1000000 + num_articles):
+        corpus[str(pmcid)] = rng.sample(JOURNALS, rng.choice([1, 1, 2, 3]))
+    return corpus
+
+
+def article_xml(pmcid):
+    return (
+        f'<article><front><article-meta>'
+        f'<article-id pub-id-type="pmc">{pmcid}</article-id>'
+        f'<article-id pub-id-type="doi">10.1000/test.{pmcid}</article-id>'
+        f'<abstract><p>Abstract of {pmcid}.</p></abstract>'
+        f'</article-meta></front><body><sec><title>Intro</title><p>Body of {pmcid}.</p></sec></body></article>'
+    )
+
+
+def make_handler(corpus, stats, latency):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            url = urllib.parse.urlparse(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if url.path.endswith("esearch.fcgi"):
+                journal = re.search(r"\(\(?(.+?)\[Journal\]", params["term"]).group(1)
+                ids = [pmcid for pmcid, journals in corpus.items() if journal in [
+                    "J Neurosci" if name == "Journal of Neuroscience" else
+                    "Proc Natl Acad Sci U S A" if name == "PNAS" else name for name in journals]]
+                start, retmax = int(params["retstart"]), int(params["retmax"])
+                body = json.dumps({"esearchresult": {"count": str(len(ids)), "idlist": ids[start:start+retmax]}})
+            else:
+                pmcids = params["id"].split(",")
+                with stats["lock"]:
+                    stats["articles"] += len(pmcids)
+                body = "<pmc-articleset>" + "".join(article_xml(pmcid) for pmcid in pmcids) + "</pmc-articleset>"
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def main(args):
+    corpus = make_corpus(args.num_articles)
+    stats = {"articles": 0, "lock": threading.Lock()}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(corpus, stats, args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/"
+
+    per_journal = sum(len(journals) for journals in corpus.values())
+    print(f"{len(corpus)} articles, {per_journal} journal matches")
+    print(f"{'per-journal download':>24}: {per_journal} articles")
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "journal_names.json"), "w") as f:
+            json.dump({"journal_names": JOURNALS}, f)
+        for run in ["cold cache", "warm cache"]:
+            stats["articles"] = 0
+            start = time.perf_counter()
+            subprocess.run(
+                [
+                    sys.executable, os.path.join(ROOT, "data", "fetch_fulltext.py"),
+                    "--base_url", base_url,
+                    "--max_workers", str(args.max_workers),
+                    "--requests_per_second", "1000",
+                ],
+                cwd=workdir, check=True, stdout=subprocess.DEVNULL,
+            )
+            elapsed = time.perf_counter() - start
+            print(f"{run:>24}: {stats['articles']} articles in {elapsed:.2f}s")
+        num_files = sum(len(files) for _, _, files in os.walk(os.path.join(workdir, "dataset")))
+        print(f"{'fulltext files':>24}: {num_files}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PMC fulltext download volume")
+    parser.add_argument("--num_articles", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per stand-in request")
+    parser.add_argument("--max_workers", type=int, default=8)
+    args = parser.parse_args()
+    main(args)
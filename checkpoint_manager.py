@@ -0,0 +1,135 @@
+import os
+import json
+import queue
+import shutil
+import threading
+
+
+class CheckpointManager:
+    """
+    Keep the best-k checkpoints of a run ranked by validation loss.
+
+    Checkpoint files are written, and superseded checkpoints deleted, by a
+    background thread so the training loop does not block on disk I/O.
+    Metadata of the retained checkpoints (path, step, val loss/PPL, lr) is kept
+    best first in an index file under `outputdir`, which is rewritten only
+    after a checkpoint is complete and before anything it supersedes is removed.
+
+    Every run starts a new index: an index left by an earlier run in the same
+    `outputdir` is moved to `checkpoints.{n}.json` and its checkpoints are
+    never deleted (a checkpoint of the new run with the same tag overwrites
+    the old one).
+    """
+    def __init__(self, outputdir, keep_best_k=3, index_name="checkpoints.json"):
+        self.outputdir = outputdir
+        self.keep_best_k = keep_best_k
+        self.index_path = os.path.join(outputdir, index_name)
+        self.entries = []
+        archive_index(self.index_path)
+        self._queue = queue.Queue()
+        self._error = None
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def best_val_loss(self):
+        return self.entries[0]["val_loss"] if self.entries else float("inf")
+
+    def best(self):
+        """Metadata of the best retained checkpoint, or None."""
+        return self.entries[0] if self.entries else None
+
+    def is_candidate(self, val_loss):
+        """Whether a checkpoint with `val_loss` would make it into the best-k."""
+        if self.keep_best_k <= 0 or len(self.entries) < self.keep_best_k:
+            return True
+        return val_loss < self.entries[-1]["val_loss"]
+
+    def submit(self, tag, val_loss, write_fn, **metadata):
+        """
+        Register checkpoint `checkpoint.{tag}` if `val_loss` makes the best-k.
+
+        Args:
+            `write_fn`
+                Called as `write_fn(path)` on the background thread to write
+                the checkpoint files; it must not touch live training state.
+
+            `metadata`
+                Extra JSON-serializable fields recorded in the index.
+
+        Returns:
+            The checkpoint path, or None if it was not kept.
+        """
+        self._raise_pending_error()
+        if not self.is_candidate(val_loss):
+            return None
+        path = os.path.join(self.outputdir, f"checkpoint.{tag}")
+        self.entries = [entry for entry in self.entries if entry["path"] != path]
+        self.entries.append({"path": path, "val_loss": val_loss, **metadata})
+        self.entries.sort(key=lambda entry: entry["val_loss"])
+        superseded = []
+        if self.keep_best_k > 0:
+            superseded = [entry["path"] for entry in self.entries[self.keep_best_k:]]
+            self.entries = self.entries[:self.keep_best_k]
+            # Never delete a path the index still lists
+            kept = {entry["path"] for entry in self.entries}
+            superseded = [old_path for old_path in superseded if old_path not in kept]
+        self._queue.put((path, write_fn, list(self.entries), superseded))
+        return path
+
+    def wait(self):
+        """Block until all submitted checkpoints are written."""
+        self._queue.join()
+        self._raise_pending_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+        self._raise_pending_error()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, write_fn, entries, superseded = item
+                os.makedirs(path, exist_ok=True)
+                write_fn(path)
+                self._write_index(entries)
+                for old_path in superseded:
+                    shutil.rmtree(old_path, ignore_errors=True)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write_index(self, entries):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"checkpoints": entries}, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def archive_index(index_path):
+    """Move an existing index to the first free `{name}.{n}.json`."""
+    if not os.path.exists(index_path):
+        return
+    root, ext = os.path.splitext(index_path)
+    n = 0
+    while os.path.exists(f"{root}.{n}{ext}"):
+        n += 1
+    os.replace(index_path, f"{root}.{n}{ext}")
+
+
+def load_index(index_path):
+    """Retained checkpoints of a run, best first (empty if there is no index)."""
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)["checkpoints"]
@@ -0,0 +1,113 @@
+"""
+Chunking of tokenized documents on sentence and paragraph boundaries
+(`--chunking sentence`).
+
+Boundaries are found on the text and mapped to tokens through the offsets of
+a fast tokenizer. A boundary level is attached to the first token after the
+boundary; chunks are cut at the strongest boundary within `slack` tokens of
+the chunk size, preferring the latest among equals.
+"""
+import re
+import bisect
+
+
+NONE, SENTENCE, PARAGRAPH, DOCUMENT = 0, 1, 2, 3
+
+# Whitespace after a sentence end (possibly closed by a quote or bracket), and newline runs
+SENTENCE_END = re.compile(r"[.!?][\"')\]]?\s+")
+PARAGRAPH_END = re.compile(r"\n\s*")
+
+
+def split_windows(text, window):
+    """
+    (start, end) character spans of at most about `window` characters
+    covering `text`, cut after a newline, else a sentence end, else a space,
+    so no tokenizer call sees a whole long document. Whitespace at a cut is
+    dropped.
+    """
+    spans = []
+    start = 0
+    while len(text) - start > window:
+        lo, hi = start + window // 2, start + window
+        cut = text.rfind("\n", lo, hi)
+        if cut < 0:
+            cut = max(text.rfind(f"{end} ", lo, hi) for end in ".!?")
+        if cut < 0:
+            cut = text.rfind(" ", lo, hi)
+        cut = hi if cut < 0 else cut + 1
+        spans.append((start, cut))
+        start = cut
+        while start < len(text) and text[start].isspace():
+            start += 1
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def boundary_levels(text, token_ends):
+    """
+    Boundary level of every token of `text`, from the end offsets of the
+    tokens (in characters of `text`, increasing).
+    """
+    levels = [NONE] * len(token_ends)
+    for level, pattern in [(SENTENCE, SENTENCE_END), (PARAGRAPH, PARAGRAPH_END)]:
+        for match in pattern.finditer(text):
+            # First token ending after the boundary, i.e. the one starting there
+            token = bisect.bisect_right(token_ends, match.end())
+            if token < len(levels):
+                levels[token] = max(levels[token], level)
+    return levels
+
+
+def pack_chunks(levels, chunk_size, slack, overlap):
+    """
+    Cut a stream of tokens with boundary `levels` into chunks.
+
+    A chunk that continues a document (does not start on a DOCUMENT boundary)
+    is prefixed with the last `overlap` tokens of the previous chunk as
+    context, within its `chunk_size`.
+
+    Returns:
+        (context_start, start, end) token spans: tokens `start:end` are new,
+        tokens `context_start:start` are repeated context.
+    """
+    spans = []
+    num_tokens = len(levels)
+    start = 0
+    while start < num_tokens:
+        context = 0 if levels[start] == DOCUMENT else min(overlap, start)
+        end = start + chunk_size - context
+        if end < num_tokens:
+            best = None
+            for candidate in range(end, max(start, end - slack), -1):
+                if levels[candidate] > (NONE if best is None else levels[best]):
+                    best = candidate
+                    if levels[candidate] == DOCUMENT:
+                        break
+            if best is not None:
+                end = best
+        else:
+            end = num_tokens
+        spans.append((start - context, start, end))
+        start = end
+    return spans
+
+
+def token_efficiency(dataset, special_ids, chunk_size):
+    """
+    Returns:
+        `efficiency`
+            Trained document tokens (labels not -1, special tokens excluded)
+            over the `chunk_size` token slots of every chunk of `dataset`, so
+            capacity lost to chunks cut short counts as waste.
+
+        `num_tokens`
+            Tokens in the chunks.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    ids = pc.list_flatten(dataset.data.column("input_ids"))
+    useful = pc.invert(pc.is_in(ids, value_set=pa.array(special_ids, type=ids.type)))
+    if "labels" in dataset.column_names:
+        useful = pc.and_(useful, pc.not_equal(pc.list_flatten(dataset.data.column("labels")), -1))
+    return pc.sum(useful).as_py() / max(len(dataset) * chunk_size, 1), len(ids)
@@ -0,0 +1,38 @@
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+
+class CommCounter:
+    """Bytes and number of gradient all-reduces issued by a DDP model."""
+    def __init__(self):
+        self.bytes = 0
+        self.calls = 0
+
+    def reset(self):
+        self.bytes = 0
+        self.calls = 0
+
+
+def counting_allreduce_hook(counter, bucket):
+    """DDP comm hook that counts the bucket size and then all-reduces as usual."""
+    buffer = bucket.buffer()
+    counter.bytes += buffer.numel() * buffer.element_size()
+    counter.calls += 1
+    return default_hooks.allreduce_hook(None, bucket)
+
+
+def register_comm_counter(ddp_model):
+    counter = CommCounter()
+    ddp_model.register_comm_hook(state=counter, hook=counting_allreduce_hook)
+    return counter
+
+
+def accumulation_group(i, num_batches, gradient_accumulation_steps):
+    """
+    For micro-batch `i` of an epoch of `num_batches`, return the number of
+    micro-batches in its update (shorter for the trailing remainder) and
+    whether `i` is the last one, i.e. where gradients are synced and the
+    optimizer steps.
+    """
+    group_start = i - i % gradient_accumulation_steps
+    group_size = min(gradient_accumulation_steps, num_batches - group_start)
+    return group_size, i + 1 == group_start + group_size
@@ -0,0 +1,101 @@
+import os
+import gzip
+import json
+import random
+import hashlib
+
+
+"""
+Pack the per-article json files under `dataset/{journal}/{fulltext,abstracts}`
+into train/validation jsonl shards for streaming training (`--train_shards`).
+
+Each line is {"text", "journal", "source", "doi"}, where `source` is
+"fulltext" or "abstract". Abstracts of articles that also have a fulltext are
+skipped, as in `dataset_counter.py`. The split is decided per doi by hash, so
+it is stable as journals are added. Documents are shuffled (by file name,
+before any text is read) so every shard mixes journals and sources.
+"""
+
+
+def is_validation(doi, valid_fraction):
+    digest = hashlib.sha1(doi.encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) / 16**8 < valid_fraction
+
+
+def list_documents(dataset_dir, journals):
+    """(journal, source, fpath) of every document."""
+    documents = []
+    for journal in journals:
+        fulltext_dir = os.path.join(dataset_dir, journal, "fulltext")
+        abstracts_dir = os.path.join(dataset_dir, journal, "abstracts")
+        fulltext_files = set(os.listdir(fulltext_dir)) if os.path.exists(fulltext_dir) else set()
+        abstract_files = set(os.listdir(abstracts_dir)) if os.path.exists(abstracts_dir) else set()
+
+        for source, source_dir, files in [
+            ("fulltext", fulltext_dir, sorted(fulltext_files)),
+            ("abstract", abstracts_dir, sorted(abstract_files - fulltext_files)),
+        ]:
+            for file in files:
+                documents.append((journal, source, os.path.join(source_dir, file)))
+    return documents
+
+
+def iter_documents(documents):
+    for journal, source, fpath in documents:
+        with open(fpath, "r") as f:
+            text = json.load(f)["text"]
+        yield {"text": text, "journal": journal, "source": source, "doi": os.path.basename(fpath)[:-len(".json")]}
+
+
+class ShardWriter:
+    def __init__(self, output_dir, split, docs_per_shard):
+        self.output_dir = os.path.join(output_dir, split)
+        self.split = split
+        self.docs_per_shard = docs_per_shard
+        self.shard_idx = 0
+        self.num_docs = 0
+        self.f = None
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def write(self, doc):
+        if self.f is None or self.num_docs == self.docs_per_shard:
+            self.close()
+            fpath = os.path.join(self.output_dir, f"{self.split}-{self.shard_idx:05d}.jsonl.gz")
+            self.f = gzip.open(fpath, "wt")
+            self.shard_idx += 1
+            self.num_docs = 0
+        self.f.write(json.dumps(doc) + "\n")
+        self.num_docs += 1
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def main(dataset_dir, output_dir, docs_per_shard, valid_fraction, seed=1):
+    with open("journal_names.json", "r") as f:
+        journal_names = json.load(f)
+
+    writers = {
+        "train": ShardWriter(output_dir, "train", docs_per_shard),
+        "validation": ShardWriter(output_dir, "validation", docs_per_shard),
+    }
+    documents = list_documents(dataset_dir, journal_names["journal_names"])
+    random.Random(seed).shuffle(documents)
+    for doc in iter_documents(documents):
+        split = "validation" if is_validation(doc["doi"], valid_fraction) else "train"
+        writers[split].write(doc)
+
+    for split, writer in writers.items():
+        writer.close()
+        print(f"[{split}]: {writer.shard_idx} shards")
+
+
+if __name__ == "__main__":
+    main(
+        dataset_dir="dataset",
+        output_dir="shards",
+        docs_per_shard=2000,
+        valid_fraction=0.01,
+    )
@@ -1,87 +1,302 @@
 import os
+import gzip
 import json
-import subprocess
-import multiprocessing
-import pandas as pd
+import time
+import hashlib
+import argparse
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
 
+"""
+Fetch the full text of the PubMed Central Open Access articles of every
+journal with the eutils api.
 
-def pubget(query, journal):
-    if not os.path.exists(f"./pubget_data_{journal}"):
-        subprocess.run(["pubget", "run", f"./pubget_data_{journal}", "-q", query])
-    else:
-        print(f"pubget_data_{journal} already exists, skipping pubget")
+Journal queries overlap (the subset journals only add a `neuroscience`
+filter), so the PMCIDs of all queries are merged first and each article is
+downloaded once into a persistent cache under `cache_dir`, shared by the
+journals it belongs to and by later runs. Cached articles are stored by the
+sha256 of their XML (`objects/ab/abcd....xml.gz`), and `index.json` maps each
+PMCID to its hash. PMCIDs that an efetch response left out are not indexed,
+so the next run asks for them again.
+"""
 
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 
-def save_individual_file(text_fpath, metadata_fpath, journal_dir):
-    df_text = pd.read_csv(text_fpath)
-    df_text_abstract = df_text["abstract"]
-    df_text_body = df_text["body"]
-    df_doi = pd.read_csv(metadata_fpath)["doi"]
-    
-    for abstract, body, doi in zip(df_text_abstract, df_text_body, df_doi):
-        if not isinstance(doi, str):
-            continue
-        
-        doi = utils.doi_reformer(doi)
-        json_fpath = os.path.join(journal_dir, f"{doi}.json")
 
-        if not isinstance(abstract, str):
-            abstract = ""
-        if not isinstance(body, str):
-            body = ""
+class Eutils:
+    """
+    Rate-limited eutils client shared by the download threads.
 
-        full_text = {"text": abstract + "\n" + body}
-        with open(json_fpath, "w") as f:
-            json.dump(full_text, f)
+    NCBI allows 3 requests per second without an api key and 10 with one;
+    `base_url` can point to a local stand-in of the eutils endpoints.
+    """
+    def __init__(self, base_url=EUTILS_URL, api_key=None, requests_per_second=3, max_retries=5):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.interval = 1 / requests_per_second
+        self.max_retries = max_retries
+        self.num_requests = 0
+        self._next_request = 0.
+        self._lock = threading.Lock()
+
+    def _wait_turn(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + self.interval
+            self.num_requests += 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def get(self, eutil, **params):
+        if self.api_key:
+            params["api_key"] = self.api_key
+        url = self.base_url + eutil + "?" + urllib.parse.urlencode(params)
+        for attempt in range(self.max_retries):
+            self._wait_turn()
+            try:
+                with urllib.request.urlopen(url, timeout=120) as f:
+                    return f.read()
+            # URLError, timeouts and dropped connections are OSErrors; a
+            # truncated response raises http.client.IncompleteRead
+            except (OSError, http.client.HTTPException) as e:
+                if isinstance(e, urllib.error.HTTPError) and e.code not in (429, 500, 502, 503, 504):
+                    raise
+                if attempt == self.max_retries - 1:
+                    raise
+                print(f"Retry {url}: {e}")
+                time.sleep(2 ** attempt)
 
 
-def process_journal(journal):
+def journal_query(journal):
     journal_code_name = utils.journal_reformer(journal, mode="fulltext")
     query = f"({journal_code_name}[Journal]) AND (2002[Publication Date] : 2022[Publication Date])"
     query = utils.query_reformer(journal, query, mode="fulltext")
+    # Same restriction to the Open Access Subset as pubget
+    return f"({query}) AND open access[filter]"
+
+
+def search_pmcids(eutils, query, page_size=10000):
+    """All PMCIDs (digits only) matching `query` in db=pmc."""
+    pmcids = []
+    while True:
+        search_data = json.loads(eutils.get(
+            "esearch.fcgi", db="pmc", term=query, retmode="json", retstart=len(pmcids), retmax=page_size))
+        ids = search_data["esearchresult"]["idlist"]
+        pmcids += ids
+        if not ids or len(pmcids) >= int(search_data["esearchresult"]["count"]):
+            return pmcids
+
+
+class ArticleCache:
+    """
+    Content-addressed store of PMC article XML with a PMCID index.
+
+    The entries of every batch are appended to `index.journal.jsonl`, so an
+    interrupted run keeps everything downloaded so far; `compact` folds the
+    journal into `index.json` once the downloads are done.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.journal_path = os.path.join(cache_dir, "index.journal.jsonl")
+        self.index = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        if os.path.exists(self.journal_path):
+            # Journal of an interrupted run, whose last line may be cut short
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        self.index.update(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+            self.compact()
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], f"{digest}.xml.gz")
+
+    def missing(self, pmcids):
+        # None entries come from older indexes that recorded misses
+        return [pmcid for pmcid in pmcids if self.index.get(pmcid) is None]
+
+    def add(self, articles):
+        """Store `articles` ({pmcid: xml bytes})."""
+        entries = {}
+        for pmcid, xml in articles.items():
+            digest = hashlib.sha256(xml).hexdigest()
+            fpath = self.object_path(digest)
+            if not os.path.exists(fpath):
+                os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                tmp_fpath = f"{fpath}.{threading.get_ident()}.tmp"
+                with gzip.open(tmp_fpath, "wb") as f:
+                    f.write(xml)
+                os.replace(tmp_fpath, fpath)
+            entries[pmcid] = digest
+        with self._lock:
+            self.index.update(entries)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.journal_path, "a") as f:
+                f.write(json.dumps(entries) + "\n")
+
+    def compact(self):
+        """Rewrite `index.json` with the journaled entries and drop the journal."""
+        with self._lock:
+            if not os.path.exists(self.journal_path):
+                return
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+            os.remove(self.journal_path)
+
+    def load(self, pmcid):
+        digest = self.index.get(pmcid)
+        if digest is None:
+            return None
+        with gzip.open(self.object_path(digest), "rb") as f:
+            return f.read()
 
-    print(f"\n\n\nFetching fulltext for {journal}\n\n\n")
-    pubget(query, journal)
 
-    for root, dirs, files in os.walk(f"./pubget_data_{journal}"):
-        for file in files:
-            if file.endswith("text.csv"):
-                text_fpath = os.path.join(root, file)
-            elif file.endswith("metadata.csv"):
-                metadata_fpath = os.path.join(root, file)
+def article_id(article, pub_id_type):
+    for elem in article.iterfind("front/article-meta/article-id"):
+        if elem.get("pub-id-type") == pub_id_type and elem.text:
+            return elem.text.strip()
+    return None
 
-    journal_dir = os.path.join(f"dataset/{journal}", "fulltext")
-    if not os.path.exists(journal_dir):
-        os.makedirs(journal_dir)
 
-    save_individual_file(text_fpath, metadata_fpath, journal_dir)
+def split_articles(fetch_data):
+    """{pmcid: xml bytes} of the articles in an efetch response of db=pmc."""
+    articles = {}
+    for article in ET.fromstring(fetch_data).iter("article"):
+        pmcid = article_id(article, "pmc") or article_id(article, "pmcid")
+        if pmcid is not None:
+            articles[pmcid.removeprefix("PMC")] = ET.tostring(article, encoding="utf-8")
+    return articles
 
-    subprocess.run(["rm", "-rf", f"./pubget_data_{journal}"])
 
+def fetch_batch(eutils, cache, pmcids):
+    """Fetch and cache a batch of articles; returns the number PMC returned."""
+    fetch_data = eutils.get("efetch.fcgi", db="pmc", id=",".join(pmcids), retmode="xml")
+    articles = split_articles(fetch_data)
+    cache.add(articles)
+    return len(articles)
 
-def main(num_processes):
+
+def paragraphs(elem):
+    """Whitespace-normalized text of the titles and paragraphs under `elem`, in order."""
+    if elem.tag in ("title", "p"):
+        text = " ".join("".join(elem.itertext()).split())
+        if text:
+            yield text
+        return
+    for child in elem:
+        yield from paragraphs(child)
+
+
+def extract_text(xml):
+    """
+    Returns:
+        `doi`, `abstract`, `body` of a JATS article (None if it has no doi).
+    """
+    article = ET.fromstring(xml)
+    doi = article_id(article, "doi")
+    abstracts = article.findall("front/article-meta/abstract")
+    # Prefer the main abstract over graphical abstracts, teasers, etc.
+    abstracts = [elem for elem in abstracts if elem.get("abstract-type") is None] or abstracts
+    abstract = "\n".join(paragraphs(abstracts[0])) if abstracts else ""
+    body = article.find("body")
+    body = "\n".join(paragraphs(body)) if body is not None else ""
+    return doi, abstract, body
+
+
+def save_individual_files(cache, journal_pmcids, dataset_dir):
+    """Write `dataset/{journal}/fulltext/{doi}.json` for every journal of each cached article."""
+    article_journals = defaultdict(list)
+    for journal, pmcids in journal_pmcids.items():
+        os.makedirs(os.path.join(dataset_dir, journal, "fulltext"), exist_ok=True)
+        for pmcid in pmcids:
+            article_journals[pmcid].append(journal)
+
+    num_saved = defaultdict(int)
+    for pmcid, journals in article_journals.items():
+        xml = cache.load(pmcid)
+        if xml is None:
+            continue
+        doi, abstract, body = extract_text(xml)
+        if doi is None:
+            continue
+        full_text = {"text": abstract + "\n" + body}
+        for journal in journals:
+            json_fpath = os.path.join(dataset_dir, journal, "fulltext", f"{utils.doi_reformer(doi)}.json")
+            with open(json_fpath, "w") as f:
+                json.dump(full_text, f)
+            num_saved[journal] += 1
+    return num_saved
+
+
+def main(base_url, cache_dir, dataset_dir, max_workers, batch_size, api_key=None, requests_per_second=3):
     with open("journal_names.json", "r") as f:
-        journal_names = json.load(f)
-
-    with multiprocessing.Pool(num_processes) as pool:
-        # Use apply_async to parallelize processing for each journal
-        results = [
-            pool.apply_async(
-                process_journal, 
-                args=(journal,)
-            ) for journal in journal_names["journal_names"]
-        ]
-        
-        # Wait for all processes to finish
-        pool.close()
-        pool.join()
-
-        # Retrieve results if needed
-        for result in results:
-            result.get()
+        journal_names = json.load(f)["journal_names"]
+
+    eutils = Eutils(base_url, api_key=api_key, requests_per_second=requests_per_second)
+    cache = ArticleCache(cache_dir)
+    with ThreadPoolExecutor(max_workers) as pool:
+        # 1. PMCIDs of every journal query
+        queries = {journal: pool.submit(search_pmcids, eutils, journal_query(journal)) for journal in journal_names}
+        journal_pmcids = {journal: query.result() for journal, query in queries.items()}
+        all_pmcids = sorted(set().union(*journal_pmcids.values()), key=int)
+        to_fetch = cache.missing(all_pmcids)
+        print(
+            f"{sum(len(pmcids) for pmcids in journal_pmcids.values())} PMCIDs over {len(journal_names)} journals, "
+            f"{len(all_pmcids)} unique, {len(to_fetch)} not cached"
+        )
+
+        # 2. Download each missing article once
+        batches = [to_fetch[x:x+batch_size] for x in range(0, len(to_fetch), batch_size)]
+        num_requested, num_fetched = 0, 0
+        for batch, num_articles in zip(batches, pool.map(lambda batch: fetch_batch(eutils, cache, batch), batches)):
+            num_requested += len(batch)
+            num_fetched += num_articles
+            print(f"Fetched {num_fetched}/{num_requested} requested articles ({len(to_fetch)} to fetch)")
+        if num_fetched < len(to_fetch):
+            print(f"{len(to_fetch) - num_fetched} articles were not returned and will be retried on the next run")
+    cache.compact()
+
+    # 3. Fan out to the journals
+    num_saved = save_individual_files(cache, journal_pmcids, dataset_dir)
+    for journal in journal_names:
+        print(f"[{journal}]: {num_saved[journal]} fulltext articles")
+    print(f"{eutils.num_requests} eutils requests")
 
 
 if __name__ == "__main__":
-    main(num_processes=100)
+    parser = argparse.ArgumentParser(description="Fetch PMC Open Access fulltext articles")
+    parser.add_argument("--base_url", type=str, default=EUTILS_URL, help="eutils base url")
+    parser.add_argument("--cache_dir", type=str, default="pmc_cache", help="Persistent article cache")
+    parser.add_argument("--dataset_dir", type=str, default="dataset", help="Output dataset dir")
+    parser.add_argument("--max_workers", type=int, default=8, help="Concurrent eutils requests")
+    parser.add_argument("--batch_size", type=int, default=100, help="Articles per efetch request")
+    parser.add_argument("--api_key", type=str, default=os.environ.get("NCBI_API_KEY"), help="NCBI api key")
+    parser.add_argument(
+        "--requests_per_second", type=float, default=3, help="eutils rate limit (10 with an api key)")
+    args = parser.parse_args()
+    main(
+        base_url=args.base_url,
+        cache_dir=args.cache_dir,
+        dataset_dir=args.dataset_dir,
+        max_workers=args.max_workers,
+        batch_size=args.batch_size,
+        api_key=args.api_key,
+        requests_per_second=args.requests_per_second,
+    )
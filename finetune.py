@@ -1,4 +1,6 @@
 import os
+import sys
+import glob
 import random
 import argparse
 import math
@@ -6,33 +8,31 @@ import pickle
 import time
 import json
 import itertools
+import contextlib
+import functools
+import hashlib
 from collections import OrderedDict
 
-import torch
-import torch.distributed as dist
-import torch.multiprocessing as mp
-from torch.nn.utils.rnn import pad_sequence
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data.distributed import DistributedSampler
-from torch.distributed import init_process_group, destroy_process_group
-from tqdm import tqdm
-from transformers import AutoTokenizer
-from transformers import AutoModelForCausalLM
-from transformers import SchedulerType, AdamW, get_scheduler
-from datasets import load_dataset
-from transformers import DataCollatorForLanguageModeling
-from accelerate import Accelerator
-
-from peft import get_peft_config, get_peft_model, LoraConfig, TaskType
-from peft import PeftConfig, PeftModel
-from torch.utils.data import DataLoader
-
-
-accelerator = Accelerator()
-# device = 'cuda' if torch.cuda.is_available() else 'cpu'
-device = accelerator.device
-random.seed(1)
-torch.manual_seed(1)
+# Heavy dependencies (torch, transformers, datasets, peft, accelerate) are
+# imported where they are used so that `--help` and `--dry_run` stay fast
+from checkpoint_manager import CheckpointManager
+from memory_utils import memory_report, format_memory_report, linear_shapes
+
+
+# Set in main, so that importing this module does not touch device state
+accelerator = None
+device = None
+
+
+def setup_accelerator():
+    global accelerator, device
+    import torch
+    from accelerate import Accelerator
+    accelerator = Accelerator()
+    # device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = accelerator.device
+    random.seed(1)
+    torch.manual_seed(1)
 
 
 def ddp_setup(rank: int, world_size: int, master_port: str):
@@ -41,6 +41,8 @@ def ddp_setup(rank: int, world_size: int, master_port: str):
         rank: Unique identifier of each process
        world_size: Total number of processes
     """
+    import torch
+    from torch.distributed import init_process_group
     os.environ["MASTER_ADDR"] = "127.0.0.1"
     os.environ["MASTER_PORT"] = master_port
     init_process_group(backend="nccl", rank=rank, world_size=world_size)
@@ -55,7 +57,22 @@ def logging(s, logfile, logging_=True, log_=True):
             f_log.write(s + '\n')
 
 
-def tokenize(element, tokenizer, args):
+def document_sources(element, source_index):
+    """Source id of every document of a batch (unknown journals count as other)."""
+    from analytics import source_id
+    journals = element.get("journal")
+    doc_types = element.get("source")
+    if journals is None or doc_types is None:
+        raise ValueError(
+            "--loss_analytics and --mixture_config need 'journal' and 'source' columns in the data "
+            "(e.g. --data_path shards, built by data/build_shards.py)"
+        )
+    return [source_id(source_index, journal, doc_type) for journal, doc_type in zip(journals, doc_types)]
+
+
+def tokenize(element, indices, tokenizer, args, source_index=None):
+    if args.chunking == "sentence":
+        return tokenize_sentences(element, indices, tokenizer, args, source_index)
     outputs = tokenizer(
         element["text"],
         truncation=True,
@@ -67,32 +84,543 @@ def tokenize(element, tokenizer, args):
     output_mask = list(itertools.chain(*outputs["attention_mask"]))
     output_ids = [output_ids[x:x+args.chunk_size] for x in range(0, len(output_ids), args.chunk_size)]
     output_mask = [output_mask[x:x+args.chunk_size] for x in range(0, len(output_mask), args.chunk_size)]
-    return {"input_ids": output_ids, "attention_mask": output_mask}
+    chunks = {"input_ids": output_ids, "attention_mask": output_mask}
+    if source_index is not None:
+        # Document and source of every token, so chunks spanning documents keep
+        # both, and the majority source of every chunk for the mixture sampler
+        from mixture import chunk_sources
+        doc_sources = document_sources(element, source_index)
+        doc_ids, source_ids = [], []
+        for sample, ids in zip(outputs["overflow_to_sample_mapping"], outputs["input_ids"]):
+            doc_ids += [indices[sample]] * len(ids)
+            source_ids += [doc_sources[sample]] * len(ids)
+        chunks["doc_ids"] = [doc_ids[x:x+args.chunk_size] for x in range(0, len(doc_ids), args.chunk_size)]
+        chunks["source_ids"] = [source_ids[x:x+args.chunk_size] for x in range(0, len(source_ids), args.chunk_size)]
+        chunks["chunk_source"] = chunk_sources(chunks["source_ids"])
+    return chunks
+
+
+def tokenize_sentences(element, indices, tokenizer, args, source_index=None):
+    """
+    `--chunking sentence`: documents are tokenized in windows of at most
+    `--tokenize_window` characters, start with a single BOS and are packed
+    into chunks cut on document, paragraph or sentence boundaries within
+    `--chunk_slack` tokens of `--chunk_size`. A chunk continuing a document
+    starts with `--chunk_overlap` tokens of context, labelled -1.
+    """
+    from chunking import DOCUMENT, split_windows, boundary_levels, pack_chunks
+    if not tokenizer.is_fast:
+        raise ValueError("--chunking sentence needs a fast tokenizer (for offsets)")
+    windows, window_docs = [], []
+    for doc, text in enumerate(element["text"]):
+        for start, end in split_windows(text or "", args.tokenize_window):
+            windows.append(text[start:end])
+            window_docs.append((doc, start))
+    outputs = tokenizer(windows, add_special_tokens=False, return_offsets_mapping=True)
+
+    # Token stream of the batch with the document and boundary level of every token
+    doc_tokens = {}
+    for (doc, start), window_ids, window_offsets in zip(window_docs, outputs["input_ids"], outputs["offset_mapping"]):
+        ids, ends = doc_tokens.setdefault(doc, ([], []))
+        ids += window_ids
+        ends += [start + end for _, end in window_offsets]
+    ids, levels, token_docs = [], [], []
+    for doc, (doc_ids, ends) in doc_tokens.items():
+        doc_levels = boundary_levels(element["text"][doc], ends)
+        if tokenizer.bos_token_id is not None:
+            doc_ids, doc_levels = [tokenizer.bos_token_id] + doc_ids, [0] + doc_levels
+        doc_levels[0] = DOCUMENT
+        ids += doc_ids
+        levels += doc_levels
+        token_docs += [doc] * len(doc_ids)
+
+    chunks = {"input_ids": [], "attention_mask": [], "labels": []}
+    spans = pack_chunks(levels, args.chunk_size, args.chunk_slack, args.chunk_overlap)
+    for context_start, start, end in spans:
+        chunks["input_ids"].append(ids[context_start:end])
+        chunks["attention_mask"].append([1] * (end - context_start))
+        chunks["labels"].append([-1] * (start - context_start) + ids[start:end])
+    if source_index is not None:
+        from mixture import chunk_sources
+        doc_sources = document_sources(element, source_index)
+        chunks["doc_ids"] = [[indices[doc] for doc in token_docs[x:y]] for x, _, y in spans]
+        chunks["source_ids"] = [[doc_sources[doc] for doc in token_docs[x:y]] for x, _, y in spans]
+        chunks["chunk_source"] = chunk_sources(chunks["source_ids"])
+    return chunks
+
+
+def log_token_efficiency(split, dataset, tokenizer, args):
+    from chunking import token_efficiency
+    efficiency, num_tokens = token_efficiency(dataset, tokenizer.all_special_ids, args.chunk_size)
+    logging(
+        f"Token efficiency ({split}, --chunking {args.chunking}): {efficiency:.2%} of {len(dataset)} chunks x "
+        f"{args.chunk_size} slots are trained document tokens ({num_tokens / max(len(dataset), 1):.1f} tokens per chunk)",
+        args.logfile,
+    )
+
+
+# Per-token chunk metadata that is not fed to the model
+METADATA_KEYS = ["doc_ids", "source_ids"]
+
+
+def tokenized_features(args, source_index=None):
+    """
+    Arrow types of the map-style tokenized columns. datasets already stores
+    `input_ids` as int32 and `attention_mask` as int8; the per-token metadata
+    would otherwise be int64 and outweigh them, so document ids (row indices
+    of the raw dataset) are int32 and source ids int16.
+    """
+    from datasets import Features, Sequence, Value
+    features = {"input_ids": Sequence(Value("int32")), "attention_mask": Sequence(Value("int8"))}
+    if args.chunking == "sentence":
+        features["labels"] = Sequence(Value("int64"))
+    if source_index is not None:
+        features["doc_ids"] = Sequence(Value("int32"))
+        features["source_ids"] = Sequence(Value("int16"))
+        features["chunk_source"] = Value("int16")
+    return Features(features)
+
+
+def tokenize_settings(args):
+    """Args that determine the tokenized dataset, recorded in `tokenized_meta.json`."""
+    settings = {key: getattr(args, key) for key in ["model_path", "data_path", "chunk_size", "chunking"]}
+    if args.chunking == "sentence":
+        settings.update({key: getattr(args, key) for key in ["chunk_slack", "chunk_overlap", "tokenize_window"]})
+    if args.loss_analytics or args.mixture_config:
+        # Source ids are only added with these flags
+        settings["journal_names"] = args.journal_names
+    return settings
+
+
+def tokenized_mismatch(args):
+    """Tokenize args of this run that differ from the ones `--tokenized_path` was tokenized with."""
+    meta_fpath = os.path.join(args.tokenized_path, "tokenized_meta.json")
+    settings = {}
+    if os.path.exists(meta_fpath):
+        with open(meta_fpath) as f:
+            settings = json.load(f).get("settings", {})
+    return [
+        f"--{key} {value} (tokenized with {settings.get(key)})"
+        for key, value in tokenize_settings(args).items() if settings.get(key) != value
+    ]
 
 
 def collate_fn(batch):
+    from torch.nn.utils.rnn import pad_sequence
     input_ids = [sample["input_ids"] for sample in batch]
     attention_masks = [sample["attention_mask"] for sample in batch]
-    labels = pad_sequence(input_ids, batch_first=True, padding_value=-1)
+    # Chunks with overlap carry their own labels (-1 on the repeated context)
+    labels = [sample["labels"] if "labels" in sample else sample["input_ids"] for sample in batch]
+    labels = pad_sequence(labels, batch_first=True, padding_value=-1)
     input_ids = pad_sequence(input_ids, batch_first=True, padding_value=0)
     attention_masks = pad_sequence(attention_masks, batch_first=True, padding_value=0)
-    return {
+    collated = {
         "input_ids": input_ids,  #.to(device),
         "attention_mask": attention_masks,  #.to(device),
         "labels": labels,  #.to(device),
     }
+    for key in METADATA_KEYS:
+        if key in batch[0]:
+            collated[key] = pad_sequence([sample[key] for sample in batch], batch_first=True, padding_value=0)
+    return collated
+
+
+def model_inputs(batch):
+    # Labels stay out too: the loss is computed from the logits here, and the
+    # model's own loss does not ignore -1
+    return {"input_ids": batch["input_ids"], "attention_mask": batch["attention_mask"]}
+
+
+def build_val_subset(dataset, token_budget, batch_size, num_strata=8, seed=1):
+    """
+    Pick a deterministic, length-stratified subset of validation chunks whose
+    total token count fits in `token_budget`, and pre-collate it once into
+    padded batches (pinned when a GPU is present) for the mid-epoch evaluations.
+
+    Chunks are sorted by length into `num_strata` equal-count strata and the
+    budget is spread across strata in proportion to their token mass, so the
+    short trailing chunks of each document are represented.
 
+    Returns:
+        `batches`
+            List of (collated batch, stratum ids of its rows).
 
-def save_checkpoint(LLM, tokenizer, outputdir, epoch):
-    fulloutput = os.path.join(outputdir, "checkpoint.{}".format(epoch))
-    os.system(f"mkdir -p {fulloutput}")
-    # save tokenizer
-    tokenizer.save_pretrained(fulloutput)
-    # save model
-    LLM.module.save_pretrained(fulloutput)
+        `strata`
+            Per-stratum dict with the total number of chunks and target tokens
+            in the full validation split, used to weight the subset estimate.
+    """
+    import torch
+    lengths = [int(mask.sum()) for mask in dataset["attention_mask"]]
+    # Target tokens as counted by `evaluate_subset` (shifted labels not -1),
+    # so overlap context and the first token of each chunk do not weigh in
+    labels = dataset["labels"] if "labels" in dataset.column_names else dataset["input_ids"]
+    targets = [int((chunk_labels[1:] != -1).sum()) for chunk_labels in labels]
+    order = sorted(range(len(lengths)), key=lambda idx: (lengths[idx], idx))
+    total_tokens = sum(lengths)
+    num_strata = max(1, min(num_strata, len(order)))
+    rng = random.Random(seed)
+
+    strata = []
+    selected = []
+    for h in range(num_strata):
+        members = order[h * len(order) // num_strata:(h + 1) * len(order) // num_strata]
+        budget = token_budget * sum(lengths[idx] for idx in members) / total_tokens
+        members = list(members)
+        rng.shuffle(members)
+        used = 0
+        picked = []
+        for idx in members:
+            # Always keep at least two chunks per stratum to estimate its variance
+            if used + lengths[idx] > budget and len(picked) >= 2:
+                break
+            picked.append(idx)
+            used += lengths[idx]
+        strata.append({
+            "num_chunks": len(members),
+            "num_tokens": sum(targets[idx] for idx in members),
+            "num_picked": len(picked),
+        })
+        selected.extend((idx, h) for idx in picked)
+
+    # Group rows of similar length together to keep padding low
+    selected.sort(key=lambda item: lengths[item[0]])
+    batches = []
+    for x in range(0, len(selected), batch_size):
+        rows = selected[x:x+batch_size]
+        batch = collate_fn([dataset[idx] for idx, _ in rows])
+        stratum_ids = torch.tensor([h for _, h in rows])
+        if torch.cuda.is_available():
+            batch = {key: value.pin_memory() for key, value in batch.items()}
+        batches.append((batch, stratum_ids))
+    return batches, strata
+
+
+def snapshot_checkpoint(LLM, tokenizer):
+    """
+    Copy the trainable (LoRA) weights to CPU and return a writer that saves
+    them with the tokenizer, so the write can run off the training loop.
+    """
+    model = accelerator.unwrap_model(LLM)
+    state_dict = {
+        name: param.detach().to("cpu", copy=True)
+        for name, param in model.state_dict().items() if "lora_" in name
+    }
+
+    def write_checkpoint(fulloutput):
+        # save tokenizer
+        tokenizer.save_pretrained(fulloutput)
+        # save model
+        model.save_pretrained(fulloutput, state_dict=state_dict)
+    return write_checkpoint
+
+
+def save_checkpoint(checkpoints, LLM, tokenizer, tag, val_loss, logfile, **metadata):
+    """Hand the checkpoint to `checkpoints` if it makes the best-k."""
+    if not checkpoints.is_candidate(val_loss):
+        return
+    ckpt_path = checkpoints.submit(
+        tag, val_loss, snapshot_checkpoint(LLM, tokenizer), val_ppl=math.exp(val_loss), **metadata)
+    logging(f"Save checkpoint to {ckpt_path}", logfile)
+
+
+def stream_samples(stream, shard_stats):
+    # `shard_stats` is unused here, but it is part of the datasets cache key,
+    # so rebuilt shards are not served from the cache of the old ones
+    for sample in stream:
+        yield {key: value.tolist() for key, value in sample.items()}
+
+
+def load_streaming_data(args, tokenizer, source_index=None):
+    """
+    Streaming counterpart of `load_dataset` + `dataset.map`: training chunks
+    are tokenized on the fly from `--train_shards`, one subset of shards per
+    rank. The (small) validation shards are materialized once so the
+    validation paths stay the same as for a map-style dataset.
+    """
+    from datasets import Dataset
+    from streaming import ShardStream, StreamLoader, shard_stats
+    tokenize_fn = functools.partial(tokenize, tokenizer=tokenizer, args=args, source_index=source_index)
+    train_stream = ShardStream(
+        args.train_shards,
+        tokenize_fn,
+        args.batch_size,
+        rank=accelerator.process_index,
+        world_size=accelerator.num_processes,
+        shuffle_buffer=args.shuffle_buffer,
+    )
+    train_loader = StreamLoader(train_stream, collate_fn=collate_fn, num_workers=args.num_workers)
+    if args.resume_stream_state:
+        stream_state_fpath = os.path.join(args.resume_stream_state, f"stream_state.rank{accelerator.process_index}.json")
+        with open(stream_state_fpath) as f:
+            train_loader.load_state_dict(json.load(f))
+        logging(f"Resume training stream at {train_loader.state_dict()}", args.logfile)
 
+    valid_stream = ShardStream(args.valid_shards, tokenize_fn, args.batch_size)
+    valid_dataset = Dataset.from_generator(stream_samples, gen_kwargs={"stream": valid_stream, "shard_stats": shard_stats(args.valid_shards)})
+    valid_dataset.set_format("torch")
+    return train_loader, valid_dataset
+
+
+def build_mixture_sampler(args, train_dataset, journal_names):
+    """
+    `MixtureSampler` over the training chunks with the temperature and
+    per-source weights of `--mixture_config`. The same seed on every rank
+    gives the same draws, which accelerate splits by batch.
+    """
+    import torch
+    from mixture import MixtureSampler, mixture_weights
+    from analytics import source_names
+    with open(args.mixture_config) as f:
+        mixture_config = json.load(f)
+    names = source_names(journal_names)
+    # One scalar per chunk, computed at tokenization, read as a single column
+    sources = train_dataset.with_format("torch", columns=["chunk_source"])[:]["chunk_source"].long()
+    counts = torch.bincount(sources, minlength=len(names)).tolist()
+    probs = mixture_weights(
+        names, counts, temperature=mixture_config.get("temperature", 1.0), weights=mixture_config.get("weights"))
+    sampler = MixtureSampler(
+        sources, names, probs, num_samples=mixture_config.get("num_samples"), seed=mixture_config.get("seed", 1))
+    if args.resume_sampler_state:
+        with open(args.resume_sampler_state) as f:
+            sampler.load_state_dict(json.load(f))
+        if accelerator.is_main_process:
+            logging(f"Resume mixture sampler at {sampler.state_dict(0)}", args.logfile)
+    for name, count, prob in zip(names, counts, probs):
+        if accelerator.is_main_process and (count > 0 or prob > 0):
+            logging(f"Mixture | {name} | chunks: {count} ({count / len(sources):.2%}) | sampled: {prob:.2%}", args.logfile)
+    return sampler
+
+
+def training_schedule(args, num_batches):
+    """
+    Math around the number of training steps, from the number of training
+    batches per epoch (None for a stream, which is cycled for max_train_steps
+    updates).
+    """
+    if num_batches is None:
+        num_train_epochs = 1
+        num_update_steps_per_epoch = args.max_train_steps
+    else:
+        num_train_epochs = args.num_train_epochs
+        num_update_steps_per_epoch = math.ceil(num_batches / args.gradient_accumulation_steps)
+    max_train_steps = num_train_epochs * num_update_steps_per_epoch
+    return {
+        "num_train_epochs": num_train_epochs,
+        "num_update_steps_per_epoch": num_update_steps_per_epoch,
+        "max_train_steps": max_train_steps,
+        "num_warmup_steps": args.num_warmup_steps * max_train_steps,
+    }
+
+
+def dry_run(args):
+    """
+    Validate paths, configs and the step math without importing the heavy
+    dependencies, loading data or touching devices. Exits non-zero on errors.
+    """
+    errors = []
+    notes = []
+
+    if os.path.isdir(args.model_path):
+        if not os.path.exists(os.path.join(args.model_path, "config.json")):
+            errors.append(f"No config.json in model_path {args.model_path}")
+    else:
+        notes.append(f"model_path {args.model_path} is not a local directory, assumed to be a hub id")
+
+    try:
+        with open(args.lora_config) as fin:
+            lora_config = json.load(fin)
+        missing = [key for key in ["lora_rank", "lora_alpha", "lora_dropout", "lora_module"] if key not in lora_config]
+        if missing:
+            errors.append(f"{args.lora_config} is missing {missing}")
+        else:
+            known_modules = linear_shapes({"hidden_size": 1, "intermediate_size": 1, "num_attention_heads": 1})
+            unknown = [module for module in lora_config["lora_module"] if module not in known_modules]
+            if unknown:
+                errors.append(f"Unknown lora_module {unknown}, expected some of {list(known_modules)}")
+    except (OSError, ValueError) as e:
+        errors.append(f"Cannot read lora_config {args.lora_config}: {e}")
+
+    if not os.path.isdir(args.outputdir):
+        errors.append(f"outputdir {args.outputdir} does not exist")
+    if args.gradient_accumulation_steps < 1:
+        errors.append("gradient_accumulation_steps must be >= 1")
+    if not 0 <= args.num_warmup_steps <= 1:
+        errors.append("num_warmup_steps is a fraction of the training steps and must be in [0, 1]")
+
+    num_batches = None
+    schedule = None
+    if args.train_shards:
+        for shard_dir in [args.train_shards, args.valid_shards]:
+            if not glob.glob(os.path.join(shard_dir, "*.jsonl*")):
+                errors.append(f"No jsonl shards in {shard_dir}")
+        schedule = training_schedule(args, None)
+    elif args.tokenized_path and os.path.exists(os.path.join(args.tokenized_path, "tokenized_meta.json")):
+        for mismatch in tokenized_mismatch(args):
+            errors.append(f"{args.tokenized_path} does not match {mismatch}")
+        with open(os.path.join(args.tokenized_path, "tokenized_meta.json")) as f:
+            num_train_samples = json.load(f)["num_rows"]["train"]
+        num_batches = math.ceil(num_train_samples / args.batch_size)
+        schedule = training_schedule(args, num_batches)
+    else:
+        if not os.path.exists(args.data_path):
+            notes.append(f"data_path {args.data_path} is not a local path, assumed to be a hub id")
+        notes.append("Step math needs the number of chunks: pass a tokenized --tokenized_path or --train_shards")
+
+    print(f"Dry run of {args.outputdir}")
+    if num_batches is not None:
+        print(f"  train batches per epoch: {num_batches}")
+    if schedule is not None:
+        for key, value in schedule.items():
+            print(f"  {key}: {value}")
+    for note in notes:
+        print(f"  note: {note}")
+    for error in errors:
+        print(f"  error: {error}")
+    if errors:
+        sys.exit(1)
+
+
+def print_memory_report(args):
+    """Log the estimated per-device memory of this config without loading weights."""
+    from transformers import AutoConfig
+    with open(args.lora_config) as fin:
+        lora_config = json.load(fin)
+    config = AutoConfig.from_pretrained(args.model_path).to_dict()
+    report = memory_report(
+        config,
+        lora_config,
+        args.batch_size,
+        args.chunk_size,
+        quantize_base=args.quantize_base,
+        optimizer=args.optimizer,
+        gradient_checkpointing=args.gradient_checkpointing,
+        attn_implementation=args.attn_implementation,
+    )
+    logging(format_memory_report(report), args.logfile)
+
+
+def weights_cache_path(model_path, cache_dir, dtype_name):
+    key = hashlib.sha1(f"{os.path.realpath(model_path)}:{dtype_name}".encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.basename(os.path.normpath(model_path))}-{dtype_name}-{key}")
+
+
+def convert_weights(model_path, cache_path, dtype_name):
+    """
+    One-time conversion of the base checkpoint into `dtype_name` safetensors
+    under `cache_path`. It is written to a temporary directory and renamed,
+    so a partial conversion is never picked up. Concurrent launches sharing
+    the cache (e.g. sweep slots) serialize on a lock file, and only the first
+    one converts.
+    """
+    import fcntl
+    import shutil
+    import torch
+    from transformers import AutoModelForCausalLM
+    with open(f"{cache_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(cache_path):
+            return
+        dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}[dtype_name]
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path, torch_dtype=dtype, low_cpu_mem_usage=True, cache_dir="/datadrive1/brian/braingpt_finetuning/cache")
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # Converted by a launch that does not take the lock (e.g. another host)
+            if not os.path.exists(cache_path):
+                raise
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def resolve_weights_cache(args):
+    """
+    Path and dtype of the converted base weights in `--weights_cache_dir`,
+    matching the accelerate mixed-precision setting. The local main process
+    of each node converts them on first use while the other ranks wait.
+    """
+    dtype_name = "bf16" if accelerator.mixed_precision == "bf16" else "fp16"
+    cache_path = weights_cache_path(args.model_path, args.weights_cache_dir, dtype_name)
+    if accelerator.is_local_main_process and not os.path.exists(cache_path):
+        logging(f"Converting {args.model_path} to {dtype_name} safetensors in {cache_path}", args.logfile)
+        os.makedirs(args.weights_cache_dir, exist_ok=True)
+        convert_weights(args.model_path, cache_path, dtype_name)
+    accelerator.wait_for_everyone()
+    return cache_path, dtype_name
+
+
+def load_base_model(args):
+    """Load the frozen base model, quantized if `--quantize_base` is set."""
+    import torch
+    from transformers import AutoModelForCausalLM
+    compute_dtype = torch.bfloat16 if accelerator.mixed_precision == "bf16" else torch.float16
+    model_path = args.model_path
+    load_kwargs = {"torch_dtype": torch.float16, "cache_dir": "/datadrive1/brian/braingpt_finetuning/cache"}
+    if args.weights_cache_dir:
+        model_path, dtype_name = resolve_weights_cache(args)
+        # Memory-mapped from the cache and already in the training dtype, so
+        # there is no cast and ranks on a node share the page cache
+        load_kwargs = {"torch_dtype": {"fp16": torch.float16, "bf16": torch.bfloat16}[dtype_name], "low_cpu_mem_usage": True}
+    load_kwargs["attn_implementation"] = args.attn_implementation
+    if args.quantize_base == "none":
+        LLM = AutoModelForCausalLM.from_pretrained(model_path, **load_kwargs)
+        if args.gradient_checkpointing:
+            LLM.gradient_checkpointing_enable()
+            # Frozen embeddings would otherwise cut the graph to the checkpointed layers
+            LLM.enable_input_require_grads()
+    else:
+        from transformers import BitsAndBytesConfig
+        from peft import prepare_model_for_kbit_training
+        quantization_config = BitsAndBytesConfig(
+            load_in_8bit=args.quantize_base == "8bit",
+            load_in_4bit=args.quantize_base == "4bit",
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=compute_dtype,
+        )
+        LLM = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            quantization_config=quantization_config,
+            device_map={"": accelerator.local_process_index},
+            **load_kwargs,
+        )
+        LLM = prepare_model_for_kbit_training(LLM, use_gradient_checkpointing=args.gradient_checkpointing)
+    if args.gradient_checkpointing:
+        LLM.config.use_cache = False
+    return LLM
+
+
+def build_optimizer(optimizer_grouped_parameters, args):
+    """AdamW, or a bitsandbytes 8-bit (optionally paged) AdamW for `--optimizer`."""
+    if args.optimizer == "adamw":
+        import torch
+        # transformers.AdamW is gone in recent releases; eps as its default
+        return torch.optim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=1e-6)
+    try:
+        import bitsandbytes as bnb
+    except ImportError:
+        raise ImportError(f"--optimizer {args.optimizer} requires bitsandbytes (pip install bitsandbytes)")
+    if args.optimizer == "paged_adamw_8bit":
+        return bnb.optim.PagedAdamW8bit(optimizer_grouped_parameters, lr=args.learning_rate)
+    return bnb.optim.AdamW8bit(optimizer_grouped_parameters, lr=args.learning_rate)
+
+
+def main(rank, args, world_size=None):
+    import torch
+    from torch.nn.parallel import DistributedDataParallel as DDP
+    from torch.utils.data import DataLoader
+    from transformers import AutoTokenizer
+    from transformers import get_scheduler
+    from datasets import load_dataset
+    from datasets import load_from_disk
+    from peft import get_peft_model, LoraConfig, TaskType
+
+    from comm_utils import register_comm_counter, accumulation_group
+
+    setup_accelerator()
+    if world_size is None:
+        world_size = accelerator.num_processes
 
-def main(rank, args, world_size):
     ## Setup DDP
     # ddp_setup(rank, world_size, args.master_port)
     print(f"rank: {rank}")
@@ -101,40 +629,101 @@ def main(rank, args, world_size):
     with open(os.path.join(args.outputdir, 'model_config.json'), 'w') as f:
         json.dump(args.__dict__, f, indent=2)
 
-    # Load huggingface dataset
-    dataset = load_dataset(args.data_path, cache_dir="/datadrive1/brian/braingpt_finetuning/cache")
-
     # Load tokenizer
     # tokenizer = AutoTokenizer.from_pretrained(args.model_path, cache_dir="/datadrive1/ken/.cache/huggingface/hub")
     tokenizer = AutoTokenizer.from_pretrained(args.model_path, cache_dir="/datadrive1/brian/braingpt_finetuning/cache")
-    tokenized_dataset = dataset.map(
-        tokenize,
-        fn_kwargs={"tokenizer": tokenizer, "args": args},
-        batched=True,
-        remove_columns=dataset["train"].column_names
-    )
-    logging("Loading {} samples for training".format(len(tokenized_dataset["train"])), args.logfile)
-    tokenized_dataset.set_format("torch")
-    train_dataloader = DataLoader(
-        tokenized_dataset["train"],
-        batch_size=args.batch_size,
-        collate_fn=collate_fn,
-        # sampler=DistributedSampler(tokenized_dataset["train"]),
-        shuffle=True,
-    )
+
+    # Source (journal x document type) tags for the loss analytics and the mixture sampler
+    source_index = None
+    if args.loss_analytics or args.mixture_config:
+        from analytics import build_source_index
+        with open(args.journal_names) as f:
+            journal_names = json.load(f)["journal_names"]
+        source_index = build_source_index(journal_names)
+
+    train_dataloader = None
+    mixture_sampler = None
+    if args.train_shards:
+        train_loader, valid_dataset = load_streaming_data(args, tokenizer, source_index)
+        logging(f"Streaming {len(train_loader.stream.shards)} training shards on rank {accelerator.process_index}", args.logfile)
+        if accelerator.is_main_process:
+            log_token_efficiency("validation", valid_dataset, tokenizer, args)
+    else:
+        if args.tokenized_path and os.path.exists(args.tokenized_path):
+            mismatch = tokenized_mismatch(args)
+            if mismatch:
+                raise ValueError(
+                    f"{args.tokenized_path} was tokenized with other args: {', '.join(mismatch)}. "
+                    "Delete it or pass another --tokenized_path"
+                )
+            # Memory-mapped, so concurrent runs share the page cache
+            tokenized_dataset = load_from_disk(args.tokenized_path)
+            if source_index is not None and "chunk_source" not in tokenized_dataset["train"].column_names:
+                raise ValueError(f"{args.tokenized_path} was tokenized without source ids")
+        else:
+            # Load huggingface dataset
+            dataset = load_dataset(args.data_path, cache_dir="/datadrive1/brian/braingpt_finetuning/cache")
+            tokenized_dataset = dataset.map(
+                tokenize,
+                fn_kwargs={"tokenizer": tokenizer, "args": args, "source_index": source_index},
+                batched=True,
+                with_indices=True,
+                remove_columns=dataset["train"].column_names,
+                features=tokenized_features(args, source_index),
+            )
+            if args.tokenized_path and accelerator.is_main_process:
+                tokenized_dataset.save_to_disk(args.tokenized_path)
+                # Row counts for the step math of --dry_run, and the args a later
+                # run has to match to reuse it
+                with open(os.path.join(args.tokenized_path, "tokenized_meta.json"), "w") as f:
+                    json.dump({
+                        "num_rows": {split: len(rows) for split, rows in tokenized_dataset.items()},
+                        "settings": tokenize_settings(args),
+                    }, f)
+        if accelerator.is_main_process:
+            for split in ["train", "validation"]:
+                log_token_efficiency(split, tokenized_dataset[split], tokenizer, args)
+        if args.tokenize_only:
+            return
+        logging("Loading {} samples for training".format(len(tokenized_dataset["train"])), args.logfile)
+        mixture_sampler = None
+        if args.mixture_config:
+            mixture_sampler = build_mixture_sampler(args, tokenized_dataset["train"], journal_names)
+        tokenized_dataset.set_format("torch")
+        train_dataloader = DataLoader(
+            tokenized_dataset["train"],
+            batch_size=args.batch_size,
+            collate_fn=collate_fn,
+            # sampler=DistributedSampler(tokenized_dataset["train"]),
+            sampler=mixture_sampler,
+            shuffle=mixture_sampler is None,
+        )
+        valid_dataset = tokenized_dataset["validation"]
     valid_dataloader = DataLoader(
-        tokenized_dataset["validation"],
+        valid_dataset,
         batch_size=args.batch_size,
         collate_fn=collate_fn,
         # sampler=DistributedSampler(tokenized_dataset["validation"]),
     )
 
+    # Fixed validation subset for mid-epoch evaluation
+    val_subset, val_strata = None, None
+    if args.val_subset_tokens > 0:
+        val_subset, val_strata = build_val_subset(
+            valid_dataset,
+            args.val_subset_tokens,
+            args.eval_batch_size,
+            num_strata=args.val_subset_strata,
+        )
+        num_picked = sum(stratum["num_picked"] for stratum in val_strata)
+        logging(f"Mid-epoch validation on {num_picked} chunks in {len(val_strata)} strata", args.logfile)
+
     # Define model
     with open(args.lora_config) as fin:
         lora_config = json.load(fin)
     os.system("cp {} {}".format(args.lora_config, os.path.join(args.outputdir, 'lora_config.json')))
     # LLM = AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float16, cache_dir="/datadrive1/ken/.cache/huggingface/hub")
-    LLM = AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float16, cache_dir="/datadrive1/brian/braingpt_finetuning/cache")
+    LLM = load_base_model(args)
     peft_config = LoraConfig(
         task_type=TaskType.CAUSAL_LM,
         inference_mode=False,
@@ -150,25 +739,32 @@ def main(rank, args, world_size):
 
     ## Initialise criterion and optimiser
     criterion = torch.nn.CrossEntropyLoss(ignore_index=-1)
+    token_criterion = torch.nn.CrossEntropyLoss(ignore_index=-1, reduction="none")
 
     ## Optimiser
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
         {
-            "params": [p for n, p in LLM.named_parameters() if not any(nd in n for nd in no_decay)],
+            "params": [p for n, p in LLM.named_parameters() if p.requires_grad and not any(nd in n for nd in no_decay)],
             "weight_decay": args.weight_decay,
         },
         {
-            "params": [p for n, p in LLM.named_parameters() if any(nd in n for nd in no_decay)],
+            "params": [p for n, p in LLM.named_parameters() if p.requires_grad and any(nd in n for nd in no_decay)],
             "weight_decay": 0.0,
         },
     ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+    optimizer = build_optimizer(optimizer_grouped_parameters, args)
 
     # Scheduler and math around the number of training steps.
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-    max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
-    num_warmup_steps = args.num_warmup_steps * max_train_steps
+    schedule = training_schedule(args, None if train_dataloader is None else len(train_dataloader))
+    num_train_epochs = schedule["num_train_epochs"]
+    max_train_steps = schedule["max_train_steps"]
+    num_warmup_steps = schedule["num_warmup_steps"]
+    if train_dataloader is None:
+        # The prepared scheduler steps once per process on every update, which
+        # the unsharded dataloader length already accounts for but a stream does not
+        max_train_steps *= accelerator.num_processes
+        num_warmup_steps *= accelerator.num_processes
 
     lr_scheduler = get_scheduler(
         name=args.lr_scheduler_type,
@@ -176,51 +772,120 @@ def main(rank, args, world_size):
         num_warmup_steps=num_warmup_steps,
         num_training_steps=max_train_steps,
     )
-    LLM, optimizer, train_dataloader, valid_dataloader, lr_scheduler = accelerator.prepare(
-        LLM, optimizer, train_dataloader, valid_dataloader, lr_scheduler)
+    if train_dataloader is None:
+        # Shards are already split per rank, so the stream is not handed to accelerate
+        LLM, optimizer, valid_dataloader, lr_scheduler = accelerator.prepare(
+            LLM, optimizer, valid_dataloader, lr_scheduler)
+        trainsize = args.max_train_steps * args.gradient_accumulation_steps
+        train_batches = (
+            {key: value.to(device) for key, value in batch.items()}
+            for batch in itertools.islice(train_loader, trainsize)
+        )
+    else:
+        LLM, optimizer, train_dataloader, valid_dataloader, lr_scheduler = accelerator.prepare(
+            LLM, optimizer, train_dataloader, valid_dataloader, lr_scheduler)
+        trainsize = len(train_dataloader)
+
+    comm_counter = None
+    if isinstance(LLM, DDP):
+        comm_counter = register_comm_counter(LLM)
 
     logging("Start training", args.logfile)
     # Training loop
-    best_val_loss = 10000
-    trainsize = len(train_dataloader)
-    for epoch in range(args.num_train_epochs):
+    checkpoints = CheckpointManager(args.outputdir, keep_best_k=args.keep_best_k)
+    analytics = None
+    if args.loss_analytics:
+        from analytics import LossAnalytics, source_names
+        analytics = LossAnalytics(source_names(journal_names), device)
+    for epoch in range(num_train_epochs):
         start = time.time()
         optimizer.zero_grad()
-        for i, batch in enumerate(train_dataloader):
-            logits = LLM(**batch).logits[:, :-1]
-            labels = batch["labels"][:, 1:]
-            loss = criterion(logits.view(-1, logits.size(-1)), labels.reshape(-1))
-            loss = loss / args.gradient_accumulation_steps
-            # loss.backward()
-            accelerator.backward(loss)
+        if train_dataloader is not None:
+            if mixture_sampler is not None:
+                # Fresh draws every epoch (accelerate does the same for the prepared copy)
+                mixture_sampler.set_epoch(epoch)
+                trainsize = len(train_dataloader)
+            train_batches = train_dataloader
+        for i, batch in enumerate(train_batches):
+            # Only the last micro-batch of an update all-reduces gradients; the
+            # trailing remainder of the epoch forms a shorter final update
+            group_size, sync_step = accumulation_group(i, trainsize, args.gradient_accumulation_steps)
+            with contextlib.nullcontext() if sync_step else accelerator.no_sync(LLM):
+                logits = LLM(**model_inputs(batch)).logits[:, :-1]
+                labels = batch["labels"][:, 1:]
+                if analytics is not None:
+                    # Per-token losses are computed once and shared by the loss and the analytics
+                    token_loss = token_criterion(logits.reshape(-1, logits.size(-1)), labels.reshape(-1)).view(labels.shape)
+                    loss = token_loss.sum() / (labels != -1).sum()
+                    analytics.update(token_loss, labels, batch["source_ids"][:, 1:], batch["doc_ids"][:, 1:])
+                else:
+                    loss = criterion(logits.view(-1, logits.size(-1)), labels.reshape(-1))
+                loss = loss / group_size
+                # loss.backward()
+                accelerator.backward(loss)
 
-            if (i + 1) % args.gradient_accumulation_steps == 0:
+            if sync_step:
                 # torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
             if (i + 1) % args.log_interval == 0 and accelerator.is_main_process:
                 elasped_time = time.time() - start
-                PPL = math.exp(loss.item() * args.gradient_accumulation_steps)
-                logging(f"Epoch {epoch} | Batch {i}/{trainsize} | PPL: {PPL} | time {elasped_time}", args.logfile)
+                PPL = math.exp(loss.item() * group_size)
+                comm_info = ""
+                if comm_counter is not None:
+                    comm_info = f" | allreduce {comm_counter.calls} calls {comm_counter.bytes / 2**20:.1f} MiB"
+                logging(f"Epoch {epoch} | Batch {i}/{trainsize} | PPL: {PPL} | time {elasped_time}{comm_info}", args.logfile)
+                if mixture_sampler is not None:
+                    samples_consumed = (i + 1) * args.batch_size * accelerator.num_processes
+                    with open(os.path.join(args.outputdir, "sampler_state.json"), "w") as f:
+                        json.dump(mixture_sampler.state_dict(samples_consumed), f)
+            if train_dataloader is None and (i + 1) % args.log_interval == 0:
+                # Ranks stream different shards and finish their passes at different times
+                stream_state_fpath = os.path.join(args.outputdir, f"stream_state.rank{accelerator.process_index}.json")
+                with open(stream_state_fpath, "w") as f:
+                    json.dump(train_loader.state_dict(), f)
+            if analytics is not None and (i + 1) % args.log_interval == 0:
+                source_nll, source_tokens = analytics.reduce(accelerator)
+                if accelerator.is_main_process:
+                    with open(os.path.join(args.outputdir, "source_stats.jsonl"), "a") as f:
+                        summary = analytics.summary(source_nll, source_tokens)
+                        f.write(json.dumps({"epoch": epoch, "batch": i, **summary}) + "\n")
             
             if args.save_interval > 0 and (i + 1) % args.save_interval == 0:
                 # Evaluate every args.save_interval steps
                 LLM.eval()
                 with torch.no_grad():
-                    val_loss = evaluate(args, LLM, valid_dataloader, criterion)
+                    if val_subset is not None:
+                        stats = evaluate_subset(LLM, val_subset, len(val_strata))
+                        torch.distributed.reduce(stats, 0)
+                        val_loss, _ = subset_estimate(stats, val_strata)
+                    else:
+                        val_loss = evaluate(args, LLM, valid_dataloader, criterion)
+                        torch.distributed.reduce(val_loss, 0)
+                        val_loss = val_loss / world_size
                     current_lr = optimizer.param_groups[0]["lr"]
-                    torch.distributed.reduce(val_loss, 0)
-                    val_loss = val_loss / world_size
                     # Save models
                     if accelerator.is_main_process:
+                        val_loss = float(val_loss)
                         val_ppl = math.exp(val_loss)
                         logging(f"Epoch {epoch} | Validation PPL: {val_ppl} | Learning rate: {current_lr}", args.logfile)
-                        if val_loss < best_val_loss:
-                            ckpt_path = os.path.join(args.outputdir, "checkpoint.{}_{}".format(epoch, (i + 1)))
-                            logging(f"Save checkpoint to {ckpt_path}", args.logfile)
-                            save_checkpoint(LLM, tokenizer, args.outputdir, f"{epoch}_{(i+1)}")
+                        save_checkpoint(
+                            checkpoints, LLM, tokenizer, f"{epoch}_{(i+1)}", val_loss, args.logfile,
+                            epoch=epoch, step=i + 1, lr=current_lr,
+                            val_estimator="full" if val_subset is None else "subset")
                 LLM.train()
+        if analytics is not None:
+            source_nll, source_tokens = analytics.reduce(accelerator)
+            analytics.write_docs(os.path.join(args.outputdir, f"doc_stats.rank{accelerator.process_index}.jsonl"))
+            if accelerator.is_main_process:
+                summary = analytics.summary(source_nll, source_tokens)
+                for journal, stats in sorted(summary["journal"].items(), key=lambda item: -item[1]["tokens"]):
+                    logging(
+                        f"End of epoch {epoch} | {journal} | NLL/token: {stats['nll_per_token']} | "
+                        f"tokens: {stats['tokens']} ({stats['share']:.2%})",
+                        args.logfile,
+                    )
         # Evaluate again at the end of epoch
         LLM.eval()
         with torch.no_grad():
@@ -228,31 +893,104 @@ def main(rank, args, world_size):
             current_lr = optimizer.param_groups[0]["lr"]
             torch.distributed.reduce(val_loss, 0)
             val_loss = val_loss / world_size
+            if val_subset is not None:
+                stats = evaluate_subset(LLM, val_subset, len(val_strata))
+                torch.distributed.reduce(stats, 0)
             # Save models
             if accelerator.is_main_process:
+                val_loss = float(val_loss)
                 val_ppl = math.exp(val_loss)
                 logging(f"End of epoch {epoch} | Validation PPL: {val_ppl} | Learning rate: {current_lr}", args.logfile)
-                if val_loss < best_val_loss:
-                    ckpt_path = os.path.join(args.outputdir, "checkpoint.{}".format(epoch))
-                    logging(f"Save checkpoint to {ckpt_path}", args.logfile)
-                    save_checkpoint(LLM, tokenizer, args.outputdir, f"{epoch}")
+                if val_subset is None:
+                    save_checkpoint(
+                        checkpoints, LLM, tokenizer, f"{epoch}", val_loss, args.logfile,
+                        epoch=epoch, step=trainsize, lr=current_lr, val_estimator="full")
+                else:
+                    # Report how well the mid-epoch subset tracks the full validation pass
+                    subset_loss, subset_stderr = subset_estimate(stats, val_strata)
+                    error = subset_loss - val_loss
+                    logging(
+                        f"End of epoch {epoch} | Validation subset loss: {subset_loss} +/- {subset_stderr} | "
+                        f"Full loss: {val_loss} | Error: {error} ({error / max(subset_stderr, 1e-12)} stderr)",
+                        args.logfile,
+                    )
+                    # Mid-epoch checkpoints are ranked by the subset estimate, so this one is too
+                    save_checkpoint(
+                        checkpoints, LLM, tokenizer, f"{epoch}", subset_loss, args.logfile,
+                        epoch=epoch, step=trainsize, lr=current_lr, val_estimator="subset", full_val_loss=val_loss)
         LLM.train()
 
+    # Wait for the pending checkpoint writes
+    checkpoints.close()
+    if accelerator.is_main_process and checkpoints.best() is not None:
+        logging(f"Best checkpoint: {checkpoints.best()['path']}", args.logfile)
+
 
 def evaluate(args, LLM, valid_dataloader, criterion):
+    import torch
     total_tokens = 0
     total_loss = 0.
     for i, batch in enumerate(valid_dataloader):
         with torch.cuda.amp.autocast():
-            logits = LLM(**batch).logits[:, :-1]
+            logits = LLM(**model_inputs(batch)).logits[:, :-1]
             labels = batch["labels"][:, 1:]
             loss = criterion(logits.view(-1, logits.size(-1)), labels.reshape(-1))
-            ntokens = (batch["attention_mask"][:, 1:] == 1).sum()
+            ntokens = (labels != -1).sum()
             total_tokens += ntokens
             total_loss += loss * ntokens
     return total_loss / total_tokens
 
 
+def evaluate_subset(LLM, val_subset, num_strata):
+    """
+    Evaluate on the pre-collated validation subset, each rank taking every
+    `num_processes`-th batch. Returns per-stratum chunk statistics
+    [n, sum L, sum T, sum L^2, sum T^2, sum L*T], where L is the summed token
+    NLL of a chunk and T its number of target tokens.
+    """
+    import torch
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=-1, reduction="none")
+    stats = torch.zeros(num_strata, 6, dtype=torch.float64, device=device)
+    for batch, stratum_ids in val_subset[accelerator.process_index::accelerator.num_processes]:
+        batch = {key: value.to(device, non_blocking=True) for key, value in batch.items()}
+        with torch.cuda.amp.autocast():
+            logits = LLM(**model_inputs(batch)).logits[:, :-1]
+        labels = batch["labels"][:, 1:]
+        token_loss = criterion(logits.reshape(-1, logits.size(-1)).float(), labels.reshape(-1))
+        chunk_loss = token_loss.view(labels.shape).sum(dim=1).double()
+        chunk_tokens = (labels != -1).sum(dim=1).double()
+        rows = torch.stack([
+            torch.ones_like(chunk_loss),
+            chunk_loss,
+            chunk_tokens,
+            chunk_loss ** 2,
+            chunk_tokens ** 2,
+            chunk_loss * chunk_tokens,
+        ], dim=1)
+        stats.index_add_(0, stratum_ids.to(device), rows)
+    return stats
+
+
+def subset_estimate(stats, strata):
+    """
+    Combine the per-stratum statistics of `evaluate_subset` into a stratified
+    ratio estimate of the per-token validation loss and its standard error.
+    """
+    total_tokens = sum(stratum["num_tokens"] for stratum in strata)
+    estimate, variance = 0., 0.
+    for (n, sum_l, sum_t, sum_ll, sum_tt, sum_lt), stratum in zip(stats.tolist(), strata):
+        if n == 0 or sum_t == 0:
+            continue
+        weight = stratum["num_tokens"] / total_tokens
+        ratio = sum_l / sum_t
+        estimate += weight * ratio
+        if n > 1:
+            residual = (sum_ll - 2 * ratio * sum_lt + ratio ** 2 * sum_tt) / (n - 1)
+            fpc = 1 - n / stratum["num_chunks"]
+            variance += weight ** 2 * fpc * residual / (n * (sum_t / n) ** 2)
+    return estimate, math.sqrt(max(variance, 0.))
+
+
 if __name__ == "__main__":
     ## Parameter groups
     parser = argparse.ArgumentParser(description="LLM finetuning")
@@ -310,7 +1048,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--lr_scheduler_type",
-        type=SchedulerType,
+        type=str,
         default="linear",
         help="The scheduler type to use.",
         choices=["linear", "cosine", "cosine_with_restarts", "polynomial", "constant", "constant_with_warmup"],
@@ -342,6 +1080,115 @@ if __name__ == "__main__":
         default=0,
         help="Saving interval",
     )
+    parser.add_argument(
+        "--tokenized_path",
+        type=str,
+        default=None,
+        help="Directory to load the tokenized dataset from, or to save it to if it does not exist",
+    )
+    parser.add_argument(
+        "--tokenize_only",
+        action="store_true",
+        help="Exit after tokenizing (use with --tokenized_path)",
+    )
+    parser.add_argument(
+        "--train_shards",
+        type=str,
+        default=None,
+        help="Directory of jsonl(.gz) training shards to stream instead of loading data_path (needs --max_train_steps)",
+    )
+    parser.add_argument(
+        "--valid_shards",
+        type=str,
+        default=None,
+        help="Directory of jsonl(.gz) validation shards used with --train_shards",
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        type=int,
+        default=10000,
+        help="Number of chunks in the shuffle buffer of the training stream",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="DataLoader workers tokenizing the training stream",
+    )
+    parser.add_argument(
+        "--resume_stream_state",
+        type=str,
+        default=None,
+        help="Output dir of the run whose stream_state.rank{r}.json files to resume the training stream positions from",
+    )
+    parser.add_argument(
+        "--chunking",
+        type=str,
+        default="concat",
+        choices=["concat", "sentence"],
+        help="concat: concatenate documents and cut every chunk_size tokens; "
+             "sentence: cut on document/paragraph/sentence boundaries with a single BOS per document",
+    )
+    parser.add_argument(
+        "--chunk_slack",
+        type=int,
+        default=128,
+        help="--chunking sentence: how many tokens short of chunk_size a chunk may be cut at a boundary",
+    )
+    parser.add_argument(
+        "--chunk_overlap",
+        type=int,
+        default=0,
+        help="--chunking sentence: tokens of the previous chunk repeated (unlabelled) as context of a continuing chunk "
+             "(at most chunk_size // 2)",
+    )
+    parser.add_argument(
+        "--tokenize_window",
+        type=int,
+        default=20000,
+        help="--chunking sentence: maximum characters of a document per tokenizer call",
+    )
+    parser.add_argument(
+        "--mixture_config",
+        type=str,
+        default=None,
+        help="Mixture sampler config (temperature, per-source weights) replacing uniform shuffling over chunks",
+    )
+    parser.add_argument(
+        "--resume_sampler_state",
+        type=str,
+        default=None,
+        help="sampler_state.json to resume the mixture sampler position from",
+    )
+    parser.add_argument(
+        "--loss_analytics",
+        action="store_true",
+        help="Track training NLL/token per source (journal x fulltext/abstract) and per document",
+    )
+    parser.add_argument(
+        "--journal_names",
+        type=str,
+        default="data/journal_names.json",
+        help="Journal list defining the source ids (documents of other journals count as 'other')",
+    )
+    parser.add_argument(
+        "--keep_best_k",
+        type=int,
+        default=3,
+        help="Number of best checkpoints (by validation loss) to keep, 0 keeps all",
+    )
+    parser.add_argument(
+        "--val_subset_tokens",
+        type=int,
+        default=0,
+        help="Token budget of the fixed validation subset used every save_interval (0 uses the full validation set)",
+    )
+    parser.add_argument(
+        "--val_subset_strata",
+        type=int,
+        default=8,
+        help="Number of chunk-length strata for the validation subset",
+    )
     parser.add_argument(
         "--master_port",
         type=str,
@@ -371,8 +1218,61 @@ if __name__ == "__main__":
         default="config/lora_config.json",
         help="LoRA configuration",
     )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Recompute decoder layer activations in backward to save memory",
+    )
+    parser.add_argument(
+        "--optimizer",
+        type=str,
+        default="adamw",
+        choices=["adamw", "adamw_8bit", "paged_adamw_8bit"],
+        help="Optimizer for the LoRA parameters (8-bit variants need bitsandbytes)",
+    )
+    parser.add_argument(
+        "--quantize_base",
+        type=str,
+        default="none",
+        choices=["none", "8bit", "4bit"],
+        help="Quantize the frozen base weights (needs bitsandbytes)",
+    )
+    parser.add_argument(
+        "--attn_implementation",
+        type=str,
+        default="sdpa",
+        choices=["eager", "sdpa", "flash_attention_2"],
+        help="Attention implementation of the base model (eager materializes the attention scores)",
+    )
+    parser.add_argument(
+        "--weights_cache_dir",
+        type=str,
+        default=None,
+        help="Node-local dir for base weights converted once to fp16/bf16 safetensors and memory-mapped afterwards",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Validate paths, configs and step math without loading anything, then exit",
+    )
+    parser.add_argument(
+        "--memory_report",
+        action="store_true",
+        help="Log the estimated per-device memory by component and exit",
+    )
     args = parser.parse_args()
-    world_size = torch.cuda.device_count()
-    print(world_size)
-    # mp.spawn(main, args=(args, world_size,), nprocs=world_size)
-    main(0, args, world_size)
+    if args.train_shards and (args.valid_shards is None or args.max_train_steps is None):
+        parser.error("--train_shards requires --valid_shards and --max_train_steps")
+    if args.chunking == "sentence" and args.chunk_overlap > args.chunk_size // 2:
+        parser.error("--chunk_overlap must be at most half of --chunk_size")
+    if args.chunking == "sentence" and args.chunk_slack >= args.chunk_size:
+        parser.error("--chunk_slack must be smaller than --chunk_size")
+    if args.train_shards and args.mixture_config:
+        parser.error("--mixture_config samples map-style datasets and cannot be used with --train_shards")
+    if args.dry_run:
+        dry_run(args)
+    elif args.memory_report:
+        print_memory_report(args)
+    else:
+        # mp.spawn(main, args=(args, world_size,), nprocs=world_size)
+        main(0, args)
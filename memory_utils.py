@@ -0,0 +1,149 @@
+"""
+Per-device memory accounting for a LoRA finetuning config.
+
+Only the model config is needed (no weights, no GPU), so the report can be
+produced on CPU before committing to a run. Numbers are estimates: allocator
+fragmentation, CUDA context and temporary buffers are not included.
+"""
+
+# Bytes per frozen base weight for each `--quantize_base` mode. bitsandbytes
+# stores one fp32 absmax per block of 64 weights in 4-bit mode.
+BASE_WEIGHT_BYTES = {"none": 2, "8bit": 1, "4bit": 0.5 + 4 / 64}
+
+# Bytes of optimizer state per trainable parameter for each `--optimizer`.
+# The 8-bit optimizers keep two uint8 states plus one fp32 absmax per block
+# of 2048 values for each of them.
+OPTIMIZER_STATE_BYTES = {
+    "adamw": 8,
+    "adamw_8bit": 2 + 2 * 4 / 2048,
+    "paged_adamw_8bit": 2 + 2 * 4 / 2048,
+}
+
+ACTIVATION_BYTES = 2
+LORA_PARAM_BYTES = 4
+
+
+def linear_shapes(config):
+    """(in_features, out_features) of every linear module in a decoder layer."""
+    hidden_size = config["hidden_size"]
+    intermediate_size = config["intermediate_size"]
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads") or num_heads
+    head_dim = config.get("head_dim") or hidden_size // num_heads
+    return {
+        "q_proj": (hidden_size, num_heads * head_dim),
+        "k_proj": (hidden_size, num_kv_heads * head_dim),
+        "v_proj": (hidden_size, num_kv_heads * head_dim),
+        "o_proj": (num_heads * head_dim, hidden_size),
+        "gate_proj": (hidden_size, intermediate_size),
+        "up_proj": (hidden_size, intermediate_size),
+        "down_proj": (intermediate_size, hidden_size),
+    }
+
+
+def count_parameters(config, lora_config):
+    """
+    Returns:
+        `linear_params`
+            Parameters of the decoder linear layers (the quantizable part).
+
+        `other_params`
+            Embeddings, lm head and norms, which stay in 16 bit.
+
+        `lora_params`
+            Trainable LoRA parameters.
+    """
+    shapes = linear_shapes(config)
+    num_layers = config["num_hidden_layers"]
+    hidden_size = config["hidden_size"]
+    vocab_size = config["vocab_size"]
+
+    linear_params = num_layers * sum(fan_in * fan_out for fan_in, fan_out in shapes.values())
+    embedding_params = vocab_size * hidden_size
+    if not config.get("tie_word_embeddings", False):
+        embedding_params *= 2
+    norm_params = (2 * num_layers + 1) * hidden_size
+    lora_params = num_layers * sum(
+        lora_config["lora_rank"] * sum(shapes[module]) for module in lora_config["lora_module"]
+    )
+    return linear_params, embedding_params + norm_params, lora_params
+
+
+def activation_elements_per_token(config, lora_config, seq_len, attn_implementation="sdpa"):
+    """
+    Activations a decoder layer keeps for backward, per token, in elements.
+
+    Only eager attention materializes the `seq_len x seq_len` scores and
+    probabilities of every head; the fused sdpa and flash attention kernels
+    keep one fp32 logsumexp per head and recompute them in backward.
+    """
+    shapes = linear_shapes(config)
+    hidden_size = config["hidden_size"]
+    num_heads = config["num_attention_heads"]
+    if attn_implementation == "eager":
+        attention = 2 * num_heads * seq_len                         # attention scores and probabilities
+    else:
+        attention = 2 * num_heads                                   # fp32 logsumexp
+    elements = (
+        2 * hidden_size                                             # layer input, attention norm output
+        + sum(shapes[name][1] for name in ("q_proj", "k_proj", "v_proj"))
+        + attention
+        + 2 * hidden_size                                           # attention output, MLP norm output
+        + 4 * config["intermediate_size"]                           # gate, up, activation, product
+    )
+    if lora_config.get("lora_dropout", 0) > 0:
+        # LoRA dropout keeps a masked copy of every adapted module input
+        elements += sum(shapes[module][0] for module in lora_config["lora_module"])
+    return elements
+
+
+def memory_report(config, lora_config, batch_size, seq_len, quantize_base="none",
+                  optimizer="adamw", gradient_checkpointing=False, attn_implementation="sdpa"):
+    """
+    Estimate per-device training memory in bytes, by component.
+
+    Args:
+        `config`
+            Model config as a dict (e.g. `AutoConfig.from_pretrained(...).to_dict()`).
+
+        `lora_config`
+            Contents of `config/lora_config.json`.
+
+        `attn_implementation`
+            Attention implementation the model is loaded with (`eager`,
+            `sdpa` or `flash_attention_2`).
+
+    Returns:
+        Ordered dict of component name to bytes, including a `total`.
+    """
+    linear_params, other_params, lora_params = count_parameters(config, lora_config)
+    num_layers = config["num_hidden_layers"]
+    tokens = batch_size * seq_len
+
+    per_layer = activation_elements_per_token(
+        config, lora_config, seq_len, attn_implementation) * tokens * ACTIVATION_BYTES
+    if gradient_checkpointing:
+        # Only layer inputs are kept; one layer is recomputed at a time
+        activations = num_layers * config["hidden_size"] * tokens * ACTIVATION_BYTES + per_layer
+    else:
+        activations = num_layers * per_layer
+
+    report = {
+        "base_weights": linear_params * BASE_WEIGHT_BYTES[quantize_base] + other_params * 2,
+        "lora_weights": lora_params * LORA_PARAM_BYTES,
+        "lora_gradients": lora_params * LORA_PARAM_BYTES,
+        "optimizer_states": lora_params * OPTIMIZER_STATE_BYTES[optimizer],
+        "activations": activations,
+        # fp32 logits and their gradient for the cross-entropy loss
+        "logits": tokens * config["vocab_size"] * 4 * 2,
+    }
+    report = {name: int(value) for name, value in report.items()}
+    report["total"] = sum(report.values())
+    return report
+
+
+def format_memory_report(report):
+    lines = []
+    for name, value in report.items():
+        lines.append(f"{name:>18}: {value / 2**30:8.3f} GiB ({value} bytes)")
+    return "\n".join(lines)
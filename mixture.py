@@ -0,0 +1,123 @@
+from collections import Counter
+
+import torch
+from torch.utils.data import Sampler
+
+
+def chunk_sources(source_ids):
+    """Source of each chunk: the source of most of its tokens."""
+    return [Counter(ids).most_common(1)[0][0] for ids in source_ids]
+
+
+def mixture_weights(names, counts, temperature=1.0, weights=None):
+    """
+    Sampling probability of each source.
+
+    Args:
+        `counts`
+            Number of chunks per source.
+
+        `temperature`
+            Probabilities start from `counts ** (1 / temperature)`: 1 keeps
+            the natural mixture, larger values flatten it towards uniform
+            over the non-empty sources.
+
+        `weights`
+            Multipliers keyed by source (`"Neuron/abstract"`), journal
+            (`"Neuron"`) or document type (`"abstract"`); all keys matching a
+            source apply.
+    """
+    weights = weights or {}
+    probs = []
+    for name, count in zip(names, counts):
+        journal, doc_type = name.rsplit("/", 1)
+        prob = count ** (1 / temperature) if count > 0 else 0.
+        for key in (name, journal, doc_type):
+            prob *= weights.get(key, 1.)
+        probs.append(prob)
+    total = sum(probs)
+    if total <= 0:
+        raise ValueError("Mixture weights leave no source to sample from")
+    return [prob / total for prob in probs]
+
+
+def alias_table(probs):
+    """
+    Vose's alias method: draw `k` uniformly, keep it with probability
+    `prob[k]`, otherwise take `alias[k]`.
+    """
+    n = len(probs)
+    prob = [p * n for p in probs]
+    alias = list(range(n))
+    small = [k for k, p in enumerate(prob) if p < 1]
+    large = [k for k, p in enumerate(prob) if p >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] -= 1 - prob[s]
+        (small if prob[l] < 1 else large).append(l)
+    for k in small + large:
+        prob[k] = 1.
+    return torch.tensor(prob, dtype=torch.float64), torch.tensor(alias)
+
+
+class MixtureSampler(Sampler):
+    """
+    Draw chunk indices by source mixture instead of uniformly over chunks.
+
+    Each draw picks a source from an alias table and then a chunk of that
+    source uniformly (with replacement), so it is O(1) whatever the number of
+    sources. Per-source index tables are built once: chunk indices grouped by
+    source in one tensor, with per-source offsets and counts.
+
+    The draws of an epoch depend only on `seed` and the epoch, so every rank
+    builds the same sequence and accelerate shards it by batch. An epoch has
+    `num_samples` draws (the number of chunks by default, so the step math is
+    unchanged). `load_state_dict` resumes mid-epoch: the first pass after it
+    skips the draws already consumed, and later passes count epochs from the
+    resumed one.
+    """
+    def __init__(self, sources, names, probs, num_samples=None, seed=1):
+        self.names = names
+        self.probs = probs
+        self.num_samples = len(sources) if num_samples is None else num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start_epoch = 0
+        self.skip_samples = 0
+        self.pass_skipped = 0
+
+        sources = torch.as_tensor(sources, dtype=torch.long)
+        self.order = torch.argsort(sources, stable=True)
+        self.counts = torch.bincount(sources, minlength=len(names))
+        self.offsets = torch.cumsum(self.counts, 0) - self.counts
+        if any(prob > 0 and count == 0 for prob, count in zip(probs, self.counts.tolist())):
+            raise ValueError("Mixture weights select a source without chunks")
+        self.prob, self.alias = alias_table(probs)
+
+    def set_epoch(self, epoch):
+        self.epoch = self.start_epoch + epoch
+
+    def __len__(self):
+        return self.num_samples - self.skip_samples
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        n = self.num_samples
+        k = torch.randint(len(self.names), (n,), generator=generator)
+        keep = torch.rand(n, generator=generator, dtype=torch.float64) < self.prob[k]
+        source = torch.where(keep, k, self.alias[k])
+        counts = self.counts[source]
+        position = (torch.rand(n, generator=generator, dtype=torch.float64) * counts).long()
+        position = torch.minimum(position, counts - 1)
+        indices = self.order[self.offsets[source] + position]
+        self.pass_skipped, self.skip_samples = self.skip_samples, 0
+        yield from indices[self.pass_skipped:].tolist()
+
+    def state_dict(self, samples_consumed):
+        """Position after `samples_consumed` draws (over all ranks) of the current pass."""
+        return {"epoch": self.epoch, "samples_consumed": self.pass_skipped + samples_consumed}
+
+    def load_state_dict(self, state):
+        self.epoch = self.start_epoch = state["epoch"]
+        self.skip_samples = state["samples_consumed"]
@@ -0,0 +1,153 @@
+import os
+import glob
+import gzip
+import json
+import random
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+
+def list_shards(shard_dir):
+    shards = sorted(
+        glob.glob(os.path.join(shard_dir, "*.jsonl")) + glob.glob(os.path.join(shard_dir, "*.jsonl.gz"))
+    )
+    if not shards:
+        raise FileNotFoundError(f"No *.jsonl or *.jsonl.gz shards in {shard_dir}")
+    return shards
+
+
+def shard_stats(shard_dir):
+    """(path, size, mtime) of every shard, to key caches on the shard contents."""
+    return [(fpath, os.path.getsize(fpath), os.path.getmtime(fpath)) for fpath in list_shards(shard_dir)]
+
+
+def read_shard(shard_fpath):
+    """Yield the documents (one JSON object per line) of a shard."""
+    opener = gzip.open if shard_fpath.endswith(".gz") else open
+    with opener(shard_fpath, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ShardStream(IterableDataset):
+    """
+    Stream tokenized chunks from a directory of jsonl shards without a local
+    copy of the corpus.
+
+    Shards are assigned to ranks deterministically (`shards[rank::world_size]`)
+    and split further across DataLoader workers, which tokenize documents on
+    the fly with `tokenize_fn` (same signature as a batched `dataset.map`
+    function with indices; a document's index packs its shard index and
+    line). Chunks go through a seeded shuffle buffer, so the order is
+    approximately random but reproducible for a given epoch, which is what
+    makes `skip_batches` resume exact (up to the last few batches of a pass,
+    once some workers have run out of shards). Resuming replays (and re-tokenizes)
+    the skipped part of the pass instead of storing buffer contents.
+    """
+    def __init__(self, shard_dir, tokenize_fn, batch_size, rank=0, world_size=1,
+                 shuffle_buffer=0, tokenize_batch_size=64, seed=1):
+        shards = list_shards(shard_dir)
+        if len(shards) < world_size:
+            raise ValueError(f"{len(shards)} shards in {shard_dir} cannot be split over {world_size} ranks")
+        # (global shard index, path), the index makes document ids unique across ranks
+        self.shards = list(enumerate(shards))[rank::world_size]
+        self.tokenize_fn = tokenize_fn
+        self.batch_size = batch_size
+        self.rank = rank
+        self.shuffle_buffer = shuffle_buffer
+        self.tokenize_batch_size = tokenize_batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.skip_batches = 0
+
+    def _worker_shards(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        # DataLoader always asks worker 0 first, so on resume the workers take
+        # over the streams of the workers whose batch was due next
+        worker_id = (worker_id + self.skip_batches) % num_workers
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        return worker_id, num_workers, shards[worker_id::num_workers]
+
+    def _chunks(self, shards):
+        docs, doc_ids = [], []
+        for shard_idx, shard_fpath in shards:
+            for line, doc in enumerate(read_shard(shard_fpath)):
+                docs.append(doc)
+                doc_ids.append((shard_idx << 32) + line)
+                if len(docs) == self.tokenize_batch_size:
+                    yield from self._tokenize(docs, doc_ids)
+                    docs, doc_ids = [], []
+        if docs:
+            yield from self._tokenize(docs, doc_ids)
+
+    def _tokenize(self, docs, doc_ids):
+        element = {key: [doc.get(key) for doc in docs] for key in docs[0]}
+        outputs = self.tokenize_fn(element, doc_ids)
+        for x in range(len(outputs["input_ids"])):
+            yield {key: torch.tensor(values[x]) for key, values in outputs.items()}
+
+    def __iter__(self):
+        worker_id, num_workers, shards = self._worker_shards()
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+        # DataLoader takes whole batches from the workers in turn, so worker
+        # `worker_id` produced every `num_workers`-th of the consumed batches
+        # (until the first worker runs out near the end of the pass)
+        skip = max(0, -(-(self.skip_batches - worker_id) // num_workers)) * self.batch_size
+
+        for x, sample in enumerate(self._shuffled(self._chunks(shards), rng)):
+            if x >= skip:
+                yield sample
+
+    def _shuffled(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            if not buffer:
+                yield sample
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class StreamLoader:
+    """
+    Endless iterator of batches over successive passes of a `ShardStream`,
+    tracking the position needed to resume mid-pass.
+    """
+    def __init__(self, stream, **dataloader_kwargs):
+        self.stream = stream
+        self.dataloader = DataLoader(stream, batch_size=stream.batch_size, **dataloader_kwargs)
+        self.batches_consumed = 0
+
+    def __iter__(self):
+        while True:
+            num_batches = 0
+            for batch in self.dataloader:
+                num_batches += 1
+                self.batches_consumed += 1
+                yield batch
+            if num_batches == 0 and self.stream.skip_batches == 0:
+                raise RuntimeError(f"Rank {self.stream.rank} got no training chunks from its shards")
+            self.stream.set_epoch(self.stream.epoch + 1)
+            self.batches_consumed = 0
+
+    def state_dict(self):
+        return {"epoch": self.stream.epoch, "batches_consumed": self.batches_consumed}
+
+    def load_state_dict(self, state):
+        self.stream.set_epoch(state["epoch"])
+        self.stream.skip_batches = state["batches_consumed"]
+        self.batches_consumed = state["batches_consumed"]
@@ -0,0 +1,224 @@
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+import subprocess
+
+from checkpoint_manager import load_index
+
+
+LORA_KEYS = ["lora_rank", "lora_alpha", "lora_dropout", "lora_module"]
+# Runs share one tokenized corpus and base model, so these cannot vary per run
+# (the source flags add the doc_ids/source_ids columns)
+SHARED_KEYS = [
+    "model_path", "data_path", "chunk_size", "chunking", "chunk_slack", "chunk_overlap", "tokenize_window",
+    "loss_analytics", "mixture_config", "journal_names",
+]
+
+
+def logging(s, logfile):
+    print(s, flush=True)
+    with open(logfile, 'a+') as f_log:
+        f_log.write(s + '\n')
+
+
+def to_cli_args(options):
+    """Turn {"batch_size": 1, "gradient_checkpointing": True} into finetune.py flags."""
+    cli_args = []
+    for key, value in options.items():
+        if isinstance(value, bool):
+            if value:
+                cli_args.append(f"--{key}")
+            continue
+        cli_args += [f"--{key}", str(value)]
+    return cli_args
+
+
+def warm_page_cache(model_path, block_size=64 * 2**20):
+    """
+    Read the checkpoint files of `model_path` once so every run loads the
+    base model from the page cache instead of disk.
+    """
+    for root, dirs, files in os.walk(model_path):
+        for file in files:
+            if not file.endswith((".safetensors", ".bin")):
+                continue
+            with open(os.path.join(root, file), "rb") as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while f.read(block_size):
+                    pass
+
+
+def tokenize_once(sweep_config, args):
+    """
+    Tokenize the corpus into `outputdir/tokenized`. If it already exists,
+    finetune.py only checks that it was tokenized with the shared args of
+    this sweep and fails otherwise.
+    """
+    tokenized_path = os.path.join(args.outputdir, "tokenized")
+    base_args = {key: sweep_config["base_args"][key] for key in SHARED_KEYS if key in sweep_config["base_args"]}
+    command = [sys.executable, "finetune.py"] + to_cli_args(base_args) + [
+        "--tokenized_path", tokenized_path,
+        "--tokenize_only",
+        "--outputdir", args.outputdir,
+        "--logfile", os.path.join(args.outputdir, "log.txt"),
+    ]
+    subprocess.run(command, check=True)
+    return tokenized_path
+
+
+def prepare_run(run, sweep_config, tokenized_path, args):
+    """Write the run's LoRA config and return its output dir and finetune.py flags."""
+    name = run["name"]
+    overrides = {key: value for key, value in run.items() if key != "name"}
+    for key in SHARED_KEYS:
+        if key in overrides:
+            raise ValueError(f"Run {name} overrides {key}, which is shared by all runs of a sweep")
+
+    rundir = os.path.join(args.outputdir, name)
+    os.makedirs(rundir, exist_ok=True)
+    with open(sweep_config["lora_config"]) as fin:
+        lora_config = json.load(fin)
+    lora_config.update({key: overrides.pop(key) for key in LORA_KEYS if key in overrides})
+    lora_config_fpath = os.path.join(rundir, "run_lora_config.json")
+    with open(lora_config_fpath, "w") as f:
+        json.dump(lora_config, f, indent=4)
+
+    options = dict(sweep_config["base_args"])
+    options.update(overrides)
+    options.update({
+        "tokenized_path": tokenized_path,
+        "outputdir": rundir,
+        "logfile": os.path.join(rundir, "log.txt"),
+        "lora_config": lora_config_fpath,
+    })
+    return rundir, to_cli_args(options)
+
+
+def collect_metrics(name, rundir, returncode, elapsed):
+    best = (load_index(os.path.join(rundir, "checkpoints.json")) or [{}])[0]
+    return {
+        "name": name,
+        "status": "ok" if returncode == 0 else f"failed ({returncode})",
+        "best_val_ppl": best.get("val_ppl"),
+        "best_epoch": best.get("epoch"),
+        "best_step": best.get("step"),
+        "lr": best.get("lr"),
+        "checkpoint": best.get("path"),
+        "minutes": round(elapsed / 60, 1),
+    }
+
+
+def run_worker(slot, devices, run_queue, results, args):
+    """Take runs from the queue and train them one at a time on `devices`."""
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES=",".join(devices))
+    while True:
+        try:
+            name, rundir, cli_args = run_queue.get_nowait()
+        except queue.Empty:
+            return
+        command = [
+            "accelerate", "launch",
+            "--config_file", args.accel_config,
+            "--num_processes", str(len(devices)),
+            "--main_process_port", str(args.master_port + slot),
+            "finetune.py",
+        ] + cli_args
+        logging(f"[slot {slot}] Start {name} on devices {','.join(devices)}", args.logfile)
+        start = time.time()
+        returncode = subprocess.run(command, env=env).returncode
+        result = collect_metrics(name, rundir, returncode, time.time() - start)
+        results.append(result)
+        logging(f"[slot {slot}] Finished {name}: {result['status']}", args.logfile)
+
+
+def write_results(results, fpath):
+    fieldnames = list(results[0].keys())
+    with open(fpath, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(results)
+    with open(fpath) as f:
+        return f.read()
+
+
+def main(args):
+    with open(args.sweep_config) as fin:
+        sweep_config = json.load(fin)
+    os.makedirs(args.outputdir, exist_ok=True)
+
+    tokenized_path = tokenize_once(sweep_config, args)
+    logging(f"Tokenized corpus at {tokenized_path}", args.logfile)
+    warm_page_cache(sweep_config["base_args"]["model_path"])
+
+    run_queue = queue.Queue()
+    for run in sweep_config["runs"]:
+        rundir, cli_args = prepare_run(run, sweep_config, tokenized_path, args)
+        run_queue.put((run["name"], rundir, cli_args))
+
+    devices = args.devices.split(",")
+    slots = [devices[x:x+args.gpus_per_run] for x in range(0, len(devices), args.gpus_per_run)]
+    slots = [slot_devices for slot_devices in slots if len(slot_devices) == args.gpus_per_run]
+    if not slots:
+        raise ValueError(f"Not enough devices in {args.devices} for {args.gpus_per_run} GPUs per run")
+    results = []
+    workers = [
+        threading.Thread(target=run_worker, args=(slot, slot_devices, run_queue, results, args))
+        for slot, slot_devices in enumerate(slots)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    results.sort(key=lambda result: [run["name"] for run in sweep_config["runs"]].index(result["name"]))
+    table = write_results(results, os.path.join(args.outputdir, "sweep_results.tsv"))
+    logging(table, args.logfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LoRA finetuning sweep")
+    parser.add_argument(
+        "--sweep_config",
+        type=str,
+        default="config/sweep_config.json",
+        help="Base finetune.py args, base LoRA config and per-run overrides",
+    )
+    parser.add_argument(
+        "--outputdir",
+        type=str,
+        default="exp/sweep",
+        help="Path to the sweep output dir (one sub-directory per run)",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default="0,1,2,3",
+        help="Comma-separated GPU ids available to the sweep",
+    )
+    parser.add_argument(
+        "--gpus_per_run",
+        type=int,
+        default=1,
+        help="Number of GPUs (processes) per run",
+    )
+    parser.add_argument(
+        "--accel_config",
+        type=str,
+        default="config/accel_config.yaml",
+        help="Accelerate config file",
+    )
+    parser.add_argument(
+        "--master_port",
+        type=int,
+        default=29500,
+        help="Base port; each concurrent run uses base + slot",
+    )
+    args = parser.parse_args()
+    args.logfile = os.path.join(args.outputdir, "sweep_log.txt")
+    main(args)